@@ -2,3 +2,9 @@ from .gateway_config import GatewayConfig
 from .thing import Thing
 from .edge_gateway_http import EdgeGatewayHttp
 from .edge_gateway_mqtt import EdgeGatewayMqtt
+from .edge_gateway_sharded import ShardedEdgeGatewayMqtt
+from . import edge_util
+
+# The asyncio gateways need async/await support (Python 3.5+)
+if edge_util.supports_asyncio:
+    from .edge_gateway_async import AsyncEdgeGateway, AsyncEdgeGatewayHttp, AsyncEdgeGatewayMqtt
@@ -0,0 +1,51 @@
+import zlib
+
+from . import edge_util
+
+ZLIB = 'zlib'
+GZIP = 'gzip'
+
+# Content-Encoding of the compressed messages, sent as a header over HTTP
+CONTENT_ENCODINGS = {ZLIB: 'deflate', GZIP: 'gzip'}
+
+# zlib wbits for the gzip container, gzip.compress is not available on Python 2
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# Compresses signed messages of at least threshold bytes with zlib or gzip at the specified level (1-9).
+# The hash is computed over the uncompressed JSON, so the receiver decodes the message before verifying it.
+# Over MQTT there are no headers, decode tells the formats apart by their first bytes
+class Codec:
+    def __init__(self, name = GZIP, level = 6, threshold = 1024):
+        if name not in CONTENT_ENCODINGS:
+            raise ValueError('Invalid compression: ' + str(name))
+        self.name = name
+        self.level = level
+        self.threshold = threshold
+        # Counters
+        self.encoded = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    # Returns the compressed message as bytes and its Content-Encoding,
+    # or the message as is and None if it is smaller than the threshold
+    def encode(self, data):
+        if len(data) < self.threshold:
+            return data, None
+        raw = data.encode('utf-8')
+        if self.name == ZLIB:
+            body = zlib.compress(raw, self.level)
+        else:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, GZIP_WBITS)
+            body = compressor.compress(raw) + compressor.flush()
+        self.encoded += 1
+        self.bytes_in += len(raw)
+        self.bytes_out += len(body)
+        return body, CONTENT_ENCODINGS[self.name]
+
+# Returns the JSON text of a message received as bytes, compressed by a Codec or not
+def decode(body):
+    if body[:2] == b'\x1f\x8b':
+        body = zlib.decompress(body, GZIP_WBITS)
+    elif body[:1] == b'\x78':
+        body = zlib.decompress(body)
+    return edge_util.get_str(body)
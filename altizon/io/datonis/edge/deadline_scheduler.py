@@ -0,0 +1,97 @@
+import heapq
+import logging
+import threading
+import time
+
+# Monotonic where available so that wall clock adjustments do not fire or delay deadlines
+clock = getattr(time, 'monotonic', time.time)
+
+# A deadline registered with the DeadlineScheduler
+class ScheduledCall:
+    def __init__(self, deadline, seq, callback):
+        self.deadline = deadline
+        self.seq = seq
+        self.callback = callback
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.deadline, self.seq) < (other.deadline, other.seq)
+
+# Runs callbacks at their deadline from a single thread, using a heap ordered by deadline.
+# Cancelled calls are removed lazily, the heap is compacted when they make up most of it
+class DeadlineScheduler:
+    def __init__(self, name = 'deadline-scheduler'):
+        self.name = name
+        self.condition = threading.Condition()
+        self.heap = []
+        self.seq = 0
+        self.cancelled_in_heap = 0
+        self.thread = None
+        # Counters
+        self.scheduled = 0
+        self.cancelled = 0
+        self.expired = 0
+
+    def start(self):
+        with self.condition:
+            if self.thread != None:
+                return
+            self.thread = threading.Thread(target=self.run, name=self.name)
+            self.thread.daemon = True
+            self.thread.start()
+
+    # Calls callback after delay seconds unless the returned call is cancelled first
+    def schedule(self, delay, callback):
+        with self.condition:
+            self.seq += 1
+            call = ScheduledCall(clock() + delay, self.seq, callback)
+            heapq.heappush(self.heap, call)
+            self.scheduled += 1
+            # Only the earliest deadline can shorten the wait of the scheduler thread
+            if self.heap[0] is call:
+                self.condition.notify()
+        self.start()
+        return call
+
+    # Returns True if the call was cancelled before it expired
+    def cancel(self, call):
+        with self.condition:
+            if call.cancelled or call.callback == None:
+                return False
+            call.cancelled = True
+            call.callback = None
+            self.cancelled += 1
+            self.cancelled_in_heap += 1
+            if self.cancelled_in_heap > 64 and self.cancelled_in_heap * 2 > len(self.heap):
+                self.heap = [c for c in self.heap if not c.cancelled]
+                heapq.heapify(self.heap)
+                self.cancelled_in_heap = 0
+            return True
+
+    # Number of calls waiting for their deadline
+    def pending(self):
+        with self.condition:
+            return len(self.heap) - self.cancelled_in_heap
+
+    def run(self):
+        while True:
+            due = []
+            with self.condition:
+                while len(self.heap) == 0:
+                    self.condition.wait()
+                now = clock()
+                while len(self.heap) > 0 and (self.heap[0].cancelled or self.heap[0].deadline <= now):
+                    call = heapq.heappop(self.heap)
+                    if call.cancelled:
+                        self.cancelled_in_heap -= 1
+                    else:
+                        due.append(call.callback)
+                        call.callback = None
+                        self.expired += 1
+                if len(due) == 0 and len(self.heap) > 0:
+                    self.condition.wait(self.heap[0].deadline - now)
+            for callback in due:
+                try:
+                    callback()
+                except:
+                    logging.error('Scheduled callback failed', exc_info=True)
@@ -1,9 +1,131 @@
+import collections
+import logging
+import uuid
+
 from . import edge_util
+from .event_batcher import EventBatcher
+from .heartbeat_scheduler import HeartbeatScheduler
+from .metrics import GatewayMetrics, MetricsRegistry
+from .outbox import Outbox
+from .rate_limiter import RateLimiter
+from .registration_cache import RegistrationCache
+from .send_queue import SendQueue
+from .thing_registry import ThingRegistry
 
 # The Edge Gateway Interface. HTTP or MQTT concrete implementations are available for consumption
 class EdgeGateway:
-    def __init__(self, in_gateway_config):
+    # Gateways that are part of another one (e.g. the shards of ShardedEdgeGatewayMqtt) pass
+    # use_registration_cache = False, the outer gateway keeps the registration cache
+    def __init__(self, in_gateway_config, use_registration_cache = True):
         self.gateway_config = in_gateway_config 
+        # Tells the metrics of this gateway apart from those of other gateways sharing the registry
+        self.gateway_id = uuid.uuid4().hex[:10].upper()
+        self.batcher = None
+        self.outbox = None
+        self.send_queue = None
+        self.rate_limiter = None
+        self.heartbeats = None
+        self.metrics = None
+        # The things registered through this gateway, by thing_key
+        self.things = ThingRegistry()
+        self.registration_cache = None
+        if use_registration_cache and in_gateway_config.registration_cache_path != None:
+            self.registration_cache = RegistrationCache(in_gateway_config.registration_cache_path, in_gateway_config)
+    
+    # Sends single thing events passed to thing_event/thing_event_async in bulk messages from now on, see EventBatcher
+    def enable_batching(self, max_events = 100, max_bytes = None, linger_seconds = 0.1):
+        self.batcher = EventBatcher(self, max_events, max_bytes, linger_seconds)
+        return self.batcher
+
+    # Sends the batched events right away and stops batching
+    def disable_batching(self):
+        if self.batcher != None:
+            batcher = self.batcher
+            self.batcher = None
+            batcher.flush()
+
+    # True if the event should go through the batcher, bulk messages are always sent as is
+    def is_batched(self, data):
+        return self.batcher != None and 'events' not in data
+
+    # Stores events and alerts in a disk-backed outbox in directory from now on, they are delivered from there
+    # in order and survive connection outages and restarts, see Outbox for the options
+    def enable_outbox(self, directory, **options):
+        self.outbox = Outbox(self, directory, **options)
+        return self.outbox
+
+    # Sends events and alerts through a bounded in-memory queue from now on, so producers do not wait for the network.
+    # See SendQueue for the backpressure policies and watermark callbacks
+    def enable_send_queue(self, max_size = 1000, policy = 'block', **options):
+        self.send_queue = SendQueue(self, max_size, policy, **options)
+        return self.send_queue
+
+    # Limits the events and alerts sent from now on, see RateLimiter. The limits are applied by the send queue
+    # or outbox thread, so callers never wait for them; the send queue is enabled if neither is
+    def enable_rate_limit(self, messages_per_second = None, bytes_per_second = None, per_thing = None, per_kind = None, burst_seconds = 1.0):
+        self.rate_limiter = RateLimiter(messages_per_second, bytes_per_second, per_thing, per_kind, burst_seconds)
+        if self.outbox == None and self.send_queue == None:
+            self.enable_send_queue()
+        return self.rate_limiter
+
+    def disable_rate_limit(self):
+        self.rate_limiter = None
+
+    # Sends heartbeats for all registered things every interval seconds from now on, skipping the things an event
+    # was sent for within the interval, see HeartbeatScheduler
+    def enable_heartbeats(self, interval = 60, max_inflight = 100):
+        self.disable_heartbeats()
+        self.heartbeats = HeartbeatScheduler(self, interval, max_inflight)
+        return self.heartbeats
+
+    def disable_heartbeats(self):
+        if self.heartbeats != None:
+            self.heartbeats.stop()
+            self.heartbeats = None
+
+    # Lets the heartbeat scheduler know that the things of the event (single or bulk) are alive
+    def note_event(self, data):
+        if self.heartbeats != None:
+            self.heartbeats.touch(data)
+
+    # Records the metrics of this gateway in registry (a new MetricsRegistry if None) from now on.
+    # With port they are served as Prometheus text at http://host:port/metrics. Returns the registry
+    def enable_metrics(self, registry = None, port = None, host = '127.0.0.1'):
+        if registry == None:
+            registry = MetricsRegistry()
+        metrics = GatewayMetrics(registry, **self.get_metrics_labels())
+        self.register_gauges(metrics)
+        self.metrics = metrics
+        if port != None:
+            registry.serve(port, host)
+        return registry
+
+    # Labels added to all the metrics of this gateway, they have to be unique to it
+    def get_metrics_labels(self):
+        return {'gateway_id': self.gateway_id}
+
+    def register_gauges(self, metrics):
+        metrics.gauge('datonis_things_registered', 'Things registered through the gateway', lambda: len(self.things))
+        metrics.gauge('datonis_batched_events_pending', 'Events waiting to be sent in a batch', lambda: self.batcher.pending() if self.batcher != None else 0)
+        metrics.gauge('datonis_send_queue_depth', 'Messages waiting in the send queue', lambda: self.send_queue.size() if self.send_queue != None else 0)
+        metrics.registry.counter('datonis_rate_limited_total', 'Times a message was held back by the rate limiter', lambda: self.rate_limiter.throttled if self.rate_limiter != None else 0, **metrics.labels)
+        metrics.registry.counter('datonis_outbox_dead_letters_total', 'Outbox messages rejected by Datonis and moved to the dead letter file',
+                                 lambda: self.outbox.dead_letters if self.outbox != None else 0, **metrics.labels)
+        metrics.gauge('datonis_outbox_backlog_bytes', 'Bytes stored in the outbox and not yet delivered', lambda: self.outbox.backlog() if self.outbox != None else 0)
+
+    # Hands an event or alert to the outbox or the send queue if one is enabled.
+    # Returns the Future for the message, or None if it has to be sent directly
+    def enqueue(self, kind, payload):
+        if self.outbox != None:
+            return self.outbox.put(kind, payload)
+        if self.send_queue != None:
+            return self.send_queue.put(kind, payload)
+        return None
+
+    # Sends a message stored in the outbox or queued in the send queue, kind is 'event' or 'alert'.
+    # Returns a concurrent.futures.Future that resolves to True if Datonis accepted the message
+    def forward_async(self, kind, payload):
+        raise NotImplementedError("Please implement this method in your concrete class")
     
     # Connects to the Datonis interface as per the protocol and host configured
     def connect(self):
@@ -13,10 +135,55 @@ class EdgeGateway:
     def thing_register(self, thing):
         raise NotImplementedError("Please implement this method in your concrete class")
 
+    # Same as thing_register, but returns a concurrent.futures.Future that resolves to the result instead of blocking
+    def thing_register_async(self, thing):
+        raise NotImplementedError("Please implement this method in your concrete class")
+
+    # Registers the specified things with Datonis. The registrations are all sent before any result is awaited,
+    # returns an OrderedDict of thing_key to the result of its registration
+    def bulk_thing_register(self, things):
+        results = self.bulk_thing_register_async(things).result()
+        failed = [thing_key for thing_key, retval in results.items() if retval != True]
+        if len(failed) > 0:
+            logging.error('registration failed for ' + str(len(failed)) + ' of ' + str(len(results)) + ' things: ' + ', '.join(failed))
+        return results
+
+    # Same as bulk_thing_register, but returns a concurrent.futures.Future that resolves to the results instead of blocking
+    def bulk_thing_register_async(self, things):
+        futures = collections.OrderedDict()
+        for thing in things:
+            futures[thing.thing_key] = self.thing_register_async(thing)
+        return edge_util.gather_results(futures)
+
+    # Sends the registration of the thing with send(data), which returns a Future for the result, unless the
+    # registration cache shows that Datonis already has the thing with the same attributes
+    def register_if_changed(self, thing, send):
+        if self.registration_cache == None:
+            return send(edge_util.create_thing_register(thing))
+        fingerprint = self.registration_cache.changed(thing)
+        if fingerprint == None:
+            logging.debug('Skipping registration of unchanged thing ' + thing.name)
+            return edge_util.completed_future(True)
+        future = send(edge_util.create_thing_register(thing))
+
+        def record(f):
+            if not f.cancelled() and f.exception() == None and f.result() == True:
+                self.registration_cache.record(thing.thing_key, fingerprint)
+        future.add_done_callback(record)
+        return future
+
+    # Forgets a registered thing, the gateway stops handling instructions for it. Returns the thing or None
+    def remove_thing(self, thing_key):
+        return self.things.remove(thing_key)
+
     # Sends a Heart Beat message to Datonis indicating that this thing is alive
     def thing_heartbeat(self, thing):
         raise NotImplementedError("Please implement this method in your concrete class")
     
+    # Same as thing_heartbeat, but returns a concurrent.futures.Future that resolves to the result instead of blocking
+    def thing_heartbeat_async(self, thing):
+        raise NotImplementedError("Please implement this method in your concrete class")
+    
     # Creates a Thing Data Packet (event) to be sent to Datonis
     def create_thing_event(self, thing, data_value, waypoint = None, ts = None):
         return edge_util.create_thing_event(thing,data_value, ts)
@@ -25,15 +192,31 @@ class EdgeGateway:
     def thing_event(self, data):
         raise NotImplementedError("Please implement this method in your concrete class")
     
+    # Same as thing_event, but returns a concurrent.futures.Future that resolves to the result instead of blocking
+    def thing_event_async(self, data):
+        raise NotImplementedError("Please implement this method in your concrete class")
+    
     # Sends a Bulk Thing data packet to Datonis
     # Here, data is assumed to be a collection of created thing events
     def bulk_thing_event(self, data):
         raise NotImplementedError("Please implement this method in your concrete class")
     
+    # Same as bulk_thing_event, but returns a concurrent.futures.Future that resolves to the result instead of blocking
+    def bulk_thing_event_async(self, data):
+        raise NotImplementedError("Please implement this method in your concrete class")
+    
     # Sends an out of band alert to Datonis for the specified thing 
     def alert(self, thing_key, alert_message, alert_level = 0, alert_data = {}):
         raise NotImplementedError("Please implement this method in your concrete class")
     
+    # Same as alert, but returns a concurrent.futures.Future that resolves to the result instead of blocking
+    def alert_async(self, thing_key, alert_message, alert_level = 0, alert_data = {}):
+        raise NotImplementedError("Please implement this method in your concrete class")
+    
     # Sends an instruction ack in the form of an alert to datonis
     def instruction_ack(self, alert_key, alert_message, alert_level = 0, alert_data = {}):
         raise NotImplementedError("Please implement this method in your concrete class")
+    
+    # Same as instruction_ack, but returns a concurrent.futures.Future that resolves to the result instead of blocking
+    def instruction_ack_async(self, alert_key, alert_message, alert_level = 0, alert_data = {}):
+        raise NotImplementedError("Please implement this method in your concrete class")
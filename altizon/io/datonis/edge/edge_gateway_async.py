@@ -0,0 +1,242 @@
+import asyncio
+import logging
+import socket
+import threading
+
+from .edge_gateway_http import EdgeGatewayHttp
+from .edge_gateway_mqtt import EdgeGatewayMqtt, CONNECTING, DISCONNECTED
+
+# The asyncio version of the Edge Gateway Interface (Python 3.5+ only).
+# Every method is a coroutine with the same arguments and result as its EdgeGateway counterpart.
+# The messages are sent by a wrapped EdgeGateway whose futures are awaited, so no thread is held per send
+class AsyncEdgeGateway:
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self.gateway_config = gateway.gateway_config
+
+    # Connects to the Datonis interface as per the protocol and host configured
+    async def connect(self):
+        raise NotImplementedError("Please implement this method in your concrete class")
+
+    # Waits until the gateway can send messages, returns False if it could not connect in time
+    async def wait_for_connection(self):
+        return True
+
+    # The *_async methods of the wrapped gateway never block, messages sent while it is connecting are held
+    # by the gateway, so only the future is awaited
+    async def send(self, future_fn, *args):
+        return await asyncio.wrap_future(future_fn(*args))
+
+    async def thing_register(self, thing):
+        retval = await self.send(self.gateway.thing_register_async, thing)
+        if retval == True:
+            logging.debug("registered thing " + thing.name)
+        else:
+            logging.error("registration failed for thing " + thing.name)
+        return retval
+
+    async def bulk_thing_register(self, things):
+        return await asyncio.wrap_future(self.gateway.bulk_thing_register_async(things))
+
+    async def thing_heartbeat(self, thing):
+        return await self.send(self.gateway.thing_heartbeat_async, thing)
+
+    def create_thing_event(self, thing, data_value, waypoint = None, ts = None):
+        return self.gateway.create_thing_event(thing, data_value, waypoint, ts)
+
+    async def thing_event(self, data):
+        return await self.send(self.gateway.thing_event_async, data)
+
+    async def bulk_thing_event(self, data):
+        return await self.send(self.gateway.bulk_thing_event_async, data)
+
+    async def alert(self, thing_key, alert_message, alert_level = 0, alert_data = {}):
+        return await self.send(self.gateway.alert_async, thing_key, alert_message, alert_level, alert_data)
+
+    async def instruction_ack(self, alert_key, alert_message, alert_level = 0, alert_data = {}):
+        return await self.send(self.gateway.instruction_ack_async, alert_key, alert_message, alert_level, alert_data)
+
+
+# HTTP requests are posted by the worker threads of EdgeGatewayHttp.post_message_async,
+# the coroutines only await their results
+class AsyncEdgeGatewayHttp(AsyncEdgeGateway):
+    def __init__(self, in_gateway_config):
+        AsyncEdgeGateway.__init__(self, EdgeGatewayHttp(in_gateway_config))
+
+    async def connect(self):
+        return True
+
+
+# The paho client of the wrapped EdgeGatewayMqtt is driven by the asyncio event loop instead of a
+# loop_start thread: socket reads and writes are dispatched with add_reader/add_writer and keep alive,
+# retries and reconnects run in a periodic task. Instruction handlers still run on the instruction worker
+# thread, so they may call the blocking methods of the wrapped gateway (passed to them as the gateway argument)
+class AsyncEdgeGatewayMqtt(AsyncEdgeGateway):
+    MISC_INTERVAL_SECONDS = 1
+
+    def __init__(self, in_gateway_config):
+        AsyncEdgeGateway.__init__(self, EdgeGatewayMqtt(in_gateway_config))
+        self.loop = None
+        self.loop_thread_id = None
+        self.sock = None
+        self.sock_fd = -1
+        self.writing = False
+        self.misc_task = None
+        self.stopped = False
+        self.ready = None
+        self.gateway.state_listeners.append(self.on_state_change)
+
+    @property
+    def instruction_handler(self):
+        return self.gateway.instruction_handler
+
+    @instruction_handler.setter
+    def instruction_handler(self, handler):
+        self.gateway.instruction_handler = handler
+
+    @property
+    def state(self):
+        return self.gateway.state
+
+    async def connect(self):
+        self.loop = asyncio.get_event_loop()
+        self.loop_thread_id = threading.current_thread().ident
+        # Set while the gateway is not connecting, mirrors EdgeGatewayMqtt.wait_for_connection
+        self.ready = asyncio.Event()
+        client = self.gateway.create_client()
+        self.gateway.set_state(CONNECTING)
+        self.stopped = False
+        try:
+            # Name resolution and the TCP/TLS handshake are blocking in paho
+            retval = await self.loop.run_in_executor(None, client.connect, self.gateway_config.api_host, self.gateway_config.api_port)
+        except (socket.error, ValueError):
+            logging.error('connect failed', exc_info=True)
+            self.gateway.set_state(DISCONNECTED)
+            return False
+        if retval != 0:
+            return False
+        # paho writes a byte to this socket pair whenever a packet is queued, from any thread
+        self.loop.add_reader(client._sockpairR.fileno(), self.on_packet_queued)
+        self.attach_socket()
+        self.gateway.start_workers()
+        self.misc_task = self.loop.create_task(self.misc_loop())
+        return True
+
+    async def disconnect(self):
+        self.stopped = True
+        if self.misc_task != None:
+            self.misc_task.cancel()
+            self.misc_task = None
+        if self.gateway.mqtt_client != None:
+            self.gateway.mqtt_client.disconnect()
+            # Flush the DISCONNECT packet, paho closes the socket once it is written
+            self.gateway.mqtt_client.loop_write()
+            self.loop.remove_reader(self.gateway.mqtt_client._sockpairR.fileno())
+        self.detach_socket()
+
+    # Waits until the gateway is no longer connecting, returns False if that takes longer than connection_timeout
+    async def wait_for_connection(self):
+        if self.gateway.is_connecting():
+            logging.info("Waiting for connection...")
+            timeout = self.gateway_config.connection_timeout
+            deadline = None if timeout == None else self.loop.time() + timeout
+            while self.gateway.is_connecting():
+                remaining = None if deadline == None else deadline - self.loop.time()
+                try:
+                    if remaining != None and remaining <= 0:
+                        raise asyncio.TimeoutError()
+                    await asyncio.wait_for(self.ready.wait(), remaining)
+                except asyncio.TimeoutError:
+                    logging.error("Timed out waiting for connection to the MQTT broker")
+                    return False
+        return True
+
+    # State changes may be reported from any thread, the event is only touched on the loop
+    def on_state_change(self, gateway):
+        if self.loop == None or self.ready == None:
+            return
+        if threading.current_thread().ident == self.loop_thread_id:
+            self.update_ready()
+        else:
+            self.loop.call_soon_threadsafe(self.update_ready)
+
+    def update_ready(self):
+        if self.gateway.is_connecting():
+            self.ready.clear()
+        else:
+            self.ready.set()
+
+    def attach_socket(self):
+        self.sock = self.gateway.mqtt_client.socket()
+        if self.sock != None:
+            # Keep the fd, paho closes the socket before reporting a lost connection
+            self.sock_fd = self.sock.fileno()
+            self.loop.add_reader(self.sock_fd, self.on_readable)
+            self.update_writer()
+
+    def detach_socket(self):
+        if self.sock != None:
+            self.loop.remove_reader(self.sock_fd)
+            self.loop.remove_writer(self.sock_fd)
+            self.sock = None
+            self.writing = False
+
+    # Registers for write readiness only while paho has packets waiting to be written
+    def update_writer(self):
+        if self.sock == None:
+            return
+        want_write = self.gateway.mqtt_client.want_write()
+        if want_write and not self.writing:
+            self.loop.add_writer(self.sock_fd, self.on_writable)
+            self.writing = True
+        elif not want_write and self.writing:
+            self.loop.remove_writer(self.sock_fd)
+            self.writing = False
+
+    def on_packet_queued(self):
+        try:
+            self.gateway.mqtt_client._sockpairR.recv(4096)
+        except socket.error:
+            pass
+        self.update_writer()
+
+    def on_readable(self):
+        client = self.gateway.mqtt_client
+        rc = client.loop_read()
+        if rc != 0 or client.socket() == None:
+            self.detach_socket()
+            return
+        # TLS may hold decrypted data that no longer shows up as socket readability
+        if hasattr(self.sock, 'pending') and self.sock.pending() > 0:
+            self.loop.call_soon(self.on_readable)
+        self.update_writer()
+
+    def on_writable(self):
+        client = self.gateway.mqtt_client
+        rc = client.loop_write()
+        if rc != 0 or client.socket() == None:
+            self.detach_socket()
+            return
+        self.update_writer()
+
+    async def misc_loop(self):
+        client = self.gateway.mqtt_client
+        while not self.stopped:
+            await asyncio.sleep(self.MISC_INTERVAL_SECONDS)
+            if client.socket() != None:
+                if client.loop_misc() != 0:
+                    self.detach_socket()
+                else:
+                    self.update_writer()
+            elif self.gateway.state != DISCONNECTED:
+                self.detach_socket()
+                policy = self.gateway.reconnect_policy
+                policy.on_disconnected()
+                await asyncio.sleep(policy.next_delay())
+                if self.stopped:
+                    break
+                try:
+                    await self.loop.run_in_executor(None, client.reconnect)
+                    self.attach_socket()
+                except socket.error:
+                    logging.debug('Reconnect failed, retrying')
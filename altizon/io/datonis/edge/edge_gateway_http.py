@@ -3,13 +3,22 @@ import logging
 import requests
 from . import edge_util
 from .edge_gateway import EdgeGateway
+from .deadline_scheduler import clock
+from . import tracing
 import collections
+import threading
+from concurrent.futures import Future
+from .priority_lanes import LaneExecutor
 
 
 class EdgeGatewayHttp(EdgeGateway):
+    # Number of threads posting messages for the *_async methods
+    ASYNC_MAX_WORKERS = 4
     
     def __init__(self, in_gateway_config):
         EdgeGateway.__init__(self, in_gateway_config)
+        self.executor = None
+        self.executor_lock = threading.Lock()
         
     # Nothing needs to be done specifically for connect in http gateway
     def connect(self):
@@ -22,14 +31,34 @@ class EdgeGatewayHttp(EdgeGateway):
         logging.debug('thing_heartbeat end')
         return retval
 
+    def thing_heartbeat_async(self, thing):
+        data = edge_util.create_thing_heartbeat(thing)
+        return self.post_message_async('/api/v3/things/heartbeat.json', data)
+
     #send either a single or bulk events
     #see bulk events
     def thing_event(self, data):
         logging.debug('thing_event start')
-        retval = self.post_message('/api/v3/things/event.json', data)
+        if self.is_batched(data):
+            retval = self.batcher.add(data).result()
+        elif self.outbox != None or self.send_queue != None:
+            self.note_event(data)
+            retval = self.enqueue('event', data).result()
+        else:
+            self.note_event(data)
+            retval = self.post_message('/api/v3/things/event.json', data)
         logging.debug('thing_event end')
         return retval
 
+    def thing_event_async(self, data):
+        if self.is_batched(data):
+            return self.batcher.add(data)
+        self.note_event(data)
+        future = self.enqueue('event', data)
+        if future != None:
+            return future
+        return self.post_message_async('/api/v3/things/event.json', data)
+
     #takes in array of thing event messages
     # see create_thing_event
     def bulk_thing_event(self, data):
@@ -40,10 +69,15 @@ class EdgeGatewayHttp(EdgeGateway):
         logging.info('bulk_event end')
         return retval
 
+    def bulk_thing_event_async(self, data):
+        bm = collections.OrderedDict()
+        bm['events'] = data
+        return self.thing_event_async(bm)
+
     def thing_register(self, thing):
         logging.debug('thing_register start')
-        data = edge_util.create_thing_register(thing)
-        retval = self.post_message('/api/v3/things/register.json', data)
+        self.things.add(thing)
+        retval = self.register_if_changed(thing, lambda data: edge_util.completed_future(self.post_message('/api/v3/things/register.json', data))).result()
         if retval == True:
             logging.debug("registered thing " + thing.name) 
         else:
@@ -51,28 +85,75 @@ class EdgeGatewayHttp(EdgeGateway):
         logging.debug('thing_register end')
         return retval
 
+    def thing_register_async(self, thing):
+        self.things.add(thing)
+        return self.register_if_changed(thing, lambda data: self.post_message_async('/api/v3/things/register.json', data))
+
     def alert(self, thing_key, alert_message, alert_level = 0, alert_data = {}):
         logging.debug('alert start')
         data = edge_util.create_alert(thing_key, alert_message, alert_level, alert_data)
-        retval = self.post_message('/api/v3/alerts.json', data)
+        if self.outbox != None or self.send_queue != None:
+            retval = self.enqueue('alert', data).result()
+        else:
+            retval = self.post_message('/api/v3/alerts.json', data)
         logging.debug('alert end')
         return retval
+
+    def alert_async(self, thing_key, alert_message, alert_level = 0, alert_data = {}):
+        data = edge_util.create_alert(thing_key, alert_message, alert_level, alert_data)
+        future = self.enqueue('alert', data)
+        if future != None:
+            return future
+        return self.post_message_async('/api/v3/alerts.json', data)
+
+    def forward_async(self, kind, payload):
+        if kind == 'alert':
+            return self.post_message_async('/api/v3/alerts.json', payload)
+        return self.post_message_async('/api/v3/things/event.json', payload)
     
     # Sends an instruction ack in the form of an alert to datonis
     def instruction_ack(self, alert_key, alert_message, alert_level = 0, alert_data = {}):
         raise NotImplementedError("This method is not supported by the HTTP Gateway")
 
-    def post_message(self, url, payload):
+    def instruction_ack_async(self, alert_key, alert_message, alert_level = 0, alert_data = {}):
+        raise NotImplementedError("This method is not supported by the HTTP Gateway")
+
+    # The status code of the response is set as future.http_code if a future is passed
+    def post_message(self, url, payload, future = None):
         logging.debug('post_message start')
         retval = False
         post_url = self.get_base_url() + url
         headers={}
+        metrics = self.metrics
+        timer = metrics.timer() if metrics != None else None
+        correlation_id = tracing.take_correlation_id(payload) if tracing.hooks else None
         data = json.dumps(payload)
-        headers['X-Dtn-Signature']= edge_util.encode(str(self.gateway_config.secret_key),data )
+        if timer != None:
+            timer.lap('serialize')
+        if correlation_id != None:
+            tracing.emit(tracing.SERIALIZE, correlation_id, size=len(data))
+        headers['X-Dtn-Signature']= self.gateway_config.get_signer().sign(data)
+        if timer != None:
+            timer.lap('sign')
+        if correlation_id != None:
+            tracing.emit(tracing.SIGN, correlation_id, hash=headers['X-Dtn-Signature'])
         headers['X-Access-Key']= str(self.gateway_config.access_key)
         headers['Content-Type'] = "application/json"
+        codec = self.gateway_config.get_codec()
+        if codec != None:
+            data, content_encoding = codec.encode(data)
+            if content_encoding != None:
+                headers['Content-Encoding'] = content_encoding
+        if metrics != None:
+            kind = self.get_message_kind(url)
+            metrics.sent(kind, len(data))
+            posted_at = clock()
         try:
             r = requests.post(post_url,  headers=headers, data=data)
+            if future != None:
+                future.http_code = r.status_code
+            if timer != None:
+                timer.lap('publish')
             logging.info('response code: ' + str(r.status_code)) 
             logging.debug('response content: ' + str(r.text)) 
             
@@ -91,9 +172,39 @@ class EdgeGatewayHttp(EdgeGateway):
             
         except requests.exceptions.ConnectionError as e:
                 logging.error ('post_message failed :' + str(e)) 
+        if metrics != None:
+            metrics.completed(kind, retval, clock() - posted_at)
+        if correlation_id != None:
+            tracing.emit(tracing.ACK, correlation_id, accepted=retval)
         logging.debug('post_message end')
         return retval
 
+    # Kind of message posted to the url for the metrics, e.g. event for /api/v3/things/event.json
+    def get_message_kind(self, url):
+        kind = url[url.rfind('/') + 1:].split('.')[0]
+        return 'alert' if kind == 'alerts' else kind
+
+    # Posts the message on a worker thread and returns a Future that resolves to the result of post_message.
+    # Waiting messages are taken by lane, priority is the lane of the message (by default that of its kind)
+    def post_message_async(self, url, payload, priority = None):
+        with self.executor_lock:
+            if self.executor == None:
+                self.executor = LaneExecutor(self.ASYNC_MAX_WORKERS, self.gateway_config.create_lane_scheduler(), 'http-post')
+        if priority == None:
+            priority = self.gateway_config.get_priority(self.get_message_kind(url))
+        future = Future()
+        future.set_running_or_notify_cancel()
+        self.executor.submit(priority, self.complete_post, future, url, payload)
+        return future
+
+    def complete_post(self, future, url, payload):
+        try:
+            retval = self.post_message(url, payload, future)
+        except BaseException as e:
+            future.set_exception(e)
+            return
+        future.set_result(retval)
+
     #returns True if result was successful
     def get_message(self, url, payload):
         logging.debug('get_message start')
@@ -2,12 +2,18 @@ import uuid
 import collections
 import json
 import logging
+import socket
 import sys
 import threading
 import time
+from concurrent.futures import Future
 
 from . import edge_util
 from .edge_gateway import EdgeGateway
+from .deadline_scheduler import DeadlineScheduler, clock
+from .instruction_pool import InstructionPool
+from .recent_keys import RecentKeys
+from . import tracing
 import paho.mqtt.client as mqtt
 
 if edge_util.is_python3:
@@ -27,23 +33,24 @@ ALIOT_PROTOCOL_VERSION = 2.0
 
 def on_connect(client, userdata, flags, rc):
     if rc == mqtt.CONNACK_ACCEPTED:
-        userdata.state = CONNECTED
         logging.info("Connected to the MQTT broker with return code: " + str(flags) + ", " + str(rc))
+        # Subscribe before releasing the waiting senders so that their acks are not missed
         userdata.subscribe_for_instructions()
         userdata.subscribe_for_acks()
+        userdata.set_state(CONNECTED)
     elif rc == mqtt.CONNACK_REFUSED_NOT_AUTHORIZED:
         logging.error("Connection Unauthorised. ")
-        userdata.state = UNAUTHORISED
+        userdata.set_state(UNAUTHORISED)
     else:
-        userdata.state = RECONNECTING
+        userdata.set_state(RECONNECTING)
 
 
 def on_disconnect(client, userdata, rc):
     if userdata.state != UNAUTHORISED:
         if rc == mqtt.MQTT_ERR_SUCCESS:
-            userdata.state = DISCONNECTED
+            userdata.set_state(DISCONNECTED)
         else:
-            userdata.state = RECONNECTING
+            userdata.set_state(RECONNECTING)
     logging.info("Disconnected from the MQTT broker with return code: " + str(rc))
 
 def on_message(client, userdata, msg):
@@ -51,15 +58,15 @@ def on_message(client, userdata, msg):
     payload = edge_util.get_str(msg.payload)
     logging.debug("Received msg with topic: " + topic + ", payload: " + payload)
     if topic.endswith('httpAck'):
-        userdata.ack_lock.acquire()
         http_ack = json.loads(payload, object_pairs_hook=collections.OrderedDict)
-        userdata.ack_context = http_ack['context']
-        userdata.ack_code = http_ack['http_code']
-        userdata.ack_content = http_ack.get('http_msg', None)
-        userdata.ack_lock.notify()
-        userdata.ack_lock.release()
+        userdata.complete_ack(http_ack['context'], http_ack['http_code'], http_ack.get('http_msg', None))
     elif topic.endswith('executeInstruction'):
-        userdata.instruction_queue.put(payload)
+        # Altizon/Datonis/<access_key>/thing/<thing_key>/executeInstruction
+        thing_key = topic.split('/')[4]
+        if thing_key in userdata.things:
+            userdata.instruction_queue.put(payload)
+        else:
+            logging.debug('Ignoring instruction for unregistered thing: ' + thing_key)
 
 def instruction_worker(thread_name,gateway):
     while True:
@@ -72,22 +79,46 @@ def instruction_worker(thread_name,gateway):
 def instruction_dispatcher(gateway):
     instruction_str = gateway.instruction_queue.get()
     logging.debug('Original instruction: ' + instruction_str)
+    instruction = verify_instruction(gateway, instruction_str)
+    if instruction != None:
+        instruction_code = instruction['instruction_wrapper']['instruction']
+        if gateway.is_duplicate_instruction(instruction):
+            logging.info('Ignoring redelivered instruction with alert_key: ' + str(instruction['alert_key']))
+        elif gateway.instruction_handler != None:
+            gateway.instruction_pool.submit(instruction['timestamp'], instruction['thing_key'], instruction['alert_key'], instruction_code)
+        else:
+            logging.warn('Received instruction: ' + json.dumps(instruction_code) + '. But, no handler set for executing it. It will be ignored')
+    else:
+        logging.warn('Hash code could not be verified for the instruction packet sent, ignoring it: ' + instruction_str)
+
+# Returns the decoded instruction without access_key and hash, or None if its hash could not be verified.
+# The hash is checked on the raw text first, so packets with a bad hash are rejected before they are decoded
+def verify_instruction(gateway, instruction_str):
+    signer = gateway.gateway_config.get_signer()
+    excised = edge_util.excise_signature(instruction_str)
+    if excised != None:
+        remainder, h = excised
+        if edge_util.compare_digest(signer.sign(remainder), h):
+            instruction = json.loads(instruction_str, object_pairs_hook=collections.OrderedDict)
+            # The excised members must have been the top level ones
+            if instruction.pop('hash', None) != h or instruction.pop('access_key', None) == None:
+                return None
+            return instruction
+        # A mismatch only proves a bad hash if the text is exactly what the sender signed
+        if edge_util.is_canonical(instruction_str):
+            return None
+    # Not in the signed form, decode it and sign it again
     instruction = json.loads(instruction_str, object_pairs_hook=collections.OrderedDict)
     instruction.pop('access_key')
     h = instruction.pop('hash', '')
     logging.debug('Received Hash: ' + h)
     remainder = json.dumps(instruction, separators=(',', ':'))
     logging.debug('Remainder instruction: ' + remainder)
-    re_calculated_hash = edge_util.encode(gateway.gateway_config.secret_key, remainder)
+    re_calculated_hash = signer.sign(remainder)
     logging.debug('Recalculated hash: ' + re_calculated_hash)
-    if h == re_calculated_hash:
-        instruction_code = instruction['instruction_wrapper']['instruction']
-        if gateway.instruction_handler != None:
-            gateway.instruction_handler(gateway, instruction['timestamp'], instruction['thing_key'], instruction['alert_key'], instruction_code)
-        else:
-            logging.warn('Received instruction: ' + json.dumps(instruction_code) + '. But, no handler set for executing it. It will be ignored')
-    else:
-        logging.warn('Hash code could not be verified for the instruction packet sent, ignoring it: ' + instruction_str)
+    if edge_util.compare_digest(re_calculated_hash, h):
+        return instruction
+    return None
 
 def random_string(string_length=10):
     "Returns a random string of length string_length."
@@ -96,96 +127,379 @@ def random_string(string_length=10):
     random = random.replace("-","") # Remove the UUID '-'.
     return random[0:string_length] # Return the random string.
 
+# Holds the state of a single published message that is waiting for its httpAck.
+# The future resolves to True if Datonis acknowledged the message with 200, False otherwise
+class PendingAck:
+    def __init__(self, context, kind = None):
+        self.context = context
+        # Only set while tracing hooks are registered
+        self.correlation_id = None
+        # Last part of the topic, e.g. event or alert
+        self.kind = kind
+        self.timeout_call = None
+        self.sent_at = edge_util.get_ts()
+        self.published_at = clock()
+        self.future = Future()
+        self.future.set_running_or_notify_cancel()
+
+# A message sent while the connection is being (re)established, it is published once the gateway is connected
+class DeferredMessage:
+    def __init__(self, topic, payload, qos, priority):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.priority = priority
+        self.timeout_call = None
+        self.future = Future()
+        self.future.set_running_or_notify_cancel()
+
+# The paho client reporting the enqueue and socket write stages of the published messages to the tracing hooks
+class TracingClient(mqtt.Client):
+    def __init__(self, *args, **kwargs):
+        mqtt.Client.__init__(self, *args, **kwargs)
+        # correlation_id of the traced messages not written yet, by mid
+        self.correlation_ids = {}
+        # mids of the traced messages that are in the out packet queue
+        self.queued_mids = set()
+        self.trace_lock = threading.Lock()
+
+    def _packet_queue(self, command, packet, mid, qos):
+        correlation_id = None
+        if tracing.hooks and (command & 0xF0) == mqtt.PUBLISH:
+            correlation_id = getattr(tracing.current, 'correlation_id', None)
+        if correlation_id == None:
+            return mqtt.Client._packet_queue(self, command, packet, mid, qos)
+        tracing.emit(tracing.ENQUEUE, correlation_id, mid=mid)
+        with self.trace_lock:
+            self.correlation_ids[mid] = correlation_id
+        # Without a network thread paho writes the packet before returning
+        rc = mqtt.Client._packet_queue(self, command, packet, mid, qos)
+        with self.trace_lock:
+            self.queued_mids.add(mid)
+        self.trace_written()
+        return rc
+
+    def _packet_write(self):
+        rc = mqtt.Client._packet_write(self)
+        if len(self.queued_mids) > 0:
+            self.trace_written()
+        return rc
+
+    # Reports the write of the queued traced messages that are no longer waiting to be written
+    def trace_written(self):
+        with self.trace_lock:
+            mids = list(self.queued_mids)
+        # The queue is read before the current packet, a packet moving from one to the other in between is seen
+        waiting = set(packet['mid'] for packet in list(self._out_packet))
+        current = self._current_out_packet
+        if current != None:
+            waiting.add(current['mid'])
+        for mid in mids:
+            if mid in waiting:
+                continue
+            with self.trace_lock:
+                self.queued_mids.discard(mid)
+                correlation_id = self.correlation_ids.pop(mid, None)
+            if correlation_id != None:
+                tracing.emit(tracing.WRITE, correlation_id, mid=mid)
+
+# The paho client sending the published messages of higher lanes (see priority_lanes) before those of lower
+# lanes that are still waiting to be written to the socket
+class PriorityClient(TracingClient):
+    def __init__(self, *args, **kwargs):
+        TracingClient.__init__(self, *args, **kwargs)
+        # The lane of the message being published by the current thread
+        self.publishing = threading.local()
+
+    def publish_in_lane(self, lane, topic, payload, qos):
+        self.publishing.lane = lane
+        try:
+            return self.publish(topic, payload, qos)
+        finally:
+            self.publishing.lane = None
+
+    def _packet_queue(self, command, packet, mid, qos):
+        lane = getattr(self.publishing, 'lane', None)
+        rc = TracingClient._packet_queue(self, command, packet, mid, qos)
+        if lane != None and (command & 0xF0) == mqtt.PUBLISH:
+            self.move_ahead(mid, lane)
+        return rc
+
+    # Moves the queued PUBLISH packet of mid ahead of the waiting packets of lower lanes. Other packets and
+    # messages resent by paho keep their place
+    def move_ahead(self, mid, lane):
+        with self._out_packet_mutex:
+            queue = self._out_packet
+            index = len(queue) - 1
+            while index >= 0 and not (queue[index]['mid'] == mid and (queue[index]['command'] & 0xF0) == mqtt.PUBLISH):
+                index -= 1
+            if index < 0:
+                # Already being written
+                return
+            packet = queue[index]
+            packet['lane'] = lane
+            position = index
+            while position > 0 and queue[position - 1].get('lane', -1) > lane:
+                position -= 1
+            if position < index:
+                del queue[index]
+                queue.insert(position, packet)
+
 class EdgeGatewayMqtt(EdgeGateway):
-    HTTP_ACK_MAX_RETRIES = 10
+    # Seconds to wait for the httpAck of a message, unless GatewayConfig.ack_timeout is set
+    HTTP_ACK_TIMEOUT_SECONDS = 10
+    # Instruction topics per SUBSCRIBE packet when subscribing for all registered things
+    SUBSCRIBE_BATCH_SIZE = 500
 
-    def __init__(self, in_gateway_config):
-        EdgeGateway.__init__(self, in_gateway_config)
+    def __init__(self, in_gateway_config, use_registration_cache = True):
+        EdgeGateway.__init__(self, in_gateway_config, use_registration_cache)
         self.mqtt_client = None
-        self.ack_lock = None
-        self.ack_context = None
-        self.ack_code = None
-        self.ack_content = None
+        # Guards pending_acks, which maps a message hash to the waiters for its httpAck
+        self.ack_lock = threading.Lock()
+        self.pending_acks = {}
+        # Expires the pending acks and the messages held while connecting
+        self.ack_scheduler = DeadlineScheduler('ack-timeout-scheduler')
+        # Messages whose ack did not arrive in time, guarded by ack_lock
+        self.ack_timeouts = 0
         self.instruction_queue = Queue.Queue()
         self.instruction_handler = None
+        # Only used when GatewayConfig.instruction_processes is set, see InstructionPool
+        self.instruction_result_handler = None
+        # Executes the verified instructions, created by start_workers
+        self.instruction_pool = None
+        # alert_keys of the instructions dispatched recently, its hits counter is the number of duplicates dropped
+        self.recent_instructions = None
+        if in_gateway_config.instruction_dedup_size > 0:
+            self.recent_instructions = RecentKeys(in_gateway_config.instruction_dedup_size, in_gateway_config.instruction_dedup_ttl)
         self.client_id = random_string(10)
-        self.things = []
         self.username = in_gateway_config.access_key
         self.password = edge_util.encode(in_gateway_config.secret_key, in_gateway_config.access_key)
         self.state = DISCONNECTED
+        # Delays the reconnect attempts and counts them along with the time spent disconnected
+        self.reconnect_policy = in_gateway_config.create_reconnect_policy()
+        # Notified on every state change, senders wait on it while the connection is being (re)established
+        self.state_condition = threading.Condition()
+        # Messages sent while connecting, in order, guarded by state_condition. They are published by a
+        # thread started when the gateway is connected, flushing is set while it runs
+        self.deferred = collections.deque()
+        self.flushing = False
+        # Callables invoked with the gateway on every state change
+        self.state_listeners = []
 
-    def connect(self):
-        self.mqtt_client = mqtt.Client(self.client_id, True, self)
+    # Creates the paho client with the callbacks and credentials of this gateway
+    def create_client(self):
+        self.mqtt_client = PriorityClient(self.client_id, True, self)
         self.mqtt_client.username_pw_set(self.username, self.password)
         self.mqtt_client.on_connect = on_connect
         self.mqtt_client.on_disconnect = on_disconnect
         self.mqtt_client.on_message = on_message
         if self.gateway_config.protocol == 'mqtts' and self.gateway_config.cert_path != None:
             self.mqtt_client.tls_set(self.gateway_config.cert_path)
-        self.state = CONNECTING
+        return self.mqtt_client
+
+    def connect(self):
+        self.create_client()
+        self.set_state(CONNECTING)
         retval = self.mqtt_client.connect(self.gateway_config.api_host, self.gateway_config.api_port)
         if retval == 0:
-            self.ack_lock = threading.Condition()
-            self.mqtt_client.loop_start()
-            # Start a new thread for instruction execution
-            thread.start_new_thread(instruction_worker, ('instruction-worker', self))
+            self.start_network_thread()
+            self.start_workers()
             return True
         else:
             return False
 
+    # Runs the paho network loop in a thread like loop_start does, but reconnects as per the reconnect policy
+    # instead of once a second. mqtt_client.loop_stop() still stops it
+    def start_network_thread(self):
+        client = self.mqtt_client
+        client._thread_terminate = False
+        client._thread = threading.Thread(target=self.network_loop, args=(client,), name='mqtt-network-' + self.client_id)
+        client._thread.daemon = True
+        client._thread.start()
+
+    def network_loop(self, client):
+        while True:
+            rc = mqtt.MQTT_ERR_SUCCESS
+            while rc == mqtt.MQTT_ERR_SUCCESS and not client._thread_terminate:
+                rc = client.loop(1.0)
+            if client._thread_terminate or self.state == DISCONNECTED or client is not self.mqtt_client:
+                return
+            self.reconnect_policy.on_disconnected()
+            delay = self.reconnect_policy.next_delay()
+            logging.info('Reconnecting to the MQTT broker in ' + ('%.2f' % delay) + ' seconds')
+            deadline = time.time() + delay
+            while not client._thread_terminate and time.time() < deadline:
+                time.sleep(min(1.0, deadline - time.time()))
+            if client._thread_terminate:
+                return
+            try:
+                client.reconnect()
+            except (socket.error, OSError):
+                logging.debug('Reconnect failed', exc_info=True)
+
+    # Starts the threads for instruction verification and execution and for expiring acks that never arrive
+    def start_workers(self):
+        if self.instruction_pool == None:
+            self.instruction_pool = InstructionPool(self, self.gateway_config.instruction_workers, self.gateway_config.instruction_processes)
+            thread.start_new_thread(instruction_worker, ('instruction-worker', self))
+        self.ack_scheduler.start()
+
+    def get_metrics_labels(self):
+        return {'client_id': self.client_id}
+
+    def register_gauges(self, metrics):
+        EdgeGateway.register_gauges(self, metrics)
+        self.register_connection_gauges(metrics)
+
+    # The metrics of the MQTT connection and the paho client
+    def register_connection_gauges(self, metrics):
+        metrics.gauge('datonis_connection_state', 'MQTT connection state: 0 connecting, 1 connected, 2 disconnected, 3 reconnecting, 4 unauthorised', lambda: self.state)
+        metrics.gauge('datonis_pending_acks', 'Messages published and waiting for their ack', lambda: len(self.pending_acks))
+        metrics.gauge('datonis_instruction_queue_depth', 'Instructions received and waiting for verification or execution',
+                      lambda: self.instruction_queue.qsize() + (self.instruction_pool.queue_depth() if self.instruction_pool != None else 0))
+        metrics.gauge('datonis_mqtt_inflight_messages', 'Messages published by paho and not yet completed with the broker',
+                      lambda: self.mqtt_client._inflight_messages if self.mqtt_client != None else 0)
+        metrics.gauge('datonis_mqtt_queued_messages', 'Outgoing messages held by paho',
+                      lambda: len(self.mqtt_client._out_messages) if self.mqtt_client != None else 0)
+        registry = metrics.registry
+        labels = metrics.labels
+        registry.counter('datonis_ack_timeouts_total', 'Messages not acknowledged in time', lambda: self.ack_timeouts, **labels)
+        registry.counter('datonis_reconnect_attempts_total', 'Attempts to reconnect to the MQTT broker', lambda: self.reconnect_policy.reconnect_attempts, **labels)
+        registry.counter('datonis_disconnected_seconds_total', 'Seconds spent disconnected from the MQTT broker', self.reconnect_policy.time_disconnected, **labels)
+        registry.counter('datonis_duplicate_instructions_total', 'Redelivered instructions that were dropped',
+                         lambda: self.recent_instructions.hits if self.recent_instructions != None else 0, **labels)
+
+    # Instructions are sent with QoS 2 but are delivered again after a reconnect, returns True for those
+    def is_duplicate_instruction(self, instruction):
+        if self.recent_instructions == None:
+            return False
+        return self.recent_instructions.check_and_add(instruction['alert_key'])
+
+    def set_state(self, state):
+        if state == CONNECTED:
+            self.reconnect_policy.on_connected()
+        elif state == RECONNECTING:
+            self.reconnect_policy.on_disconnected()
+        with self.state_condition:
+            self.state = state
+            self.state_condition.notify_all()
+            flush = not self.is_connecting() and len(self.deferred) > 0 and not self.flushing
+            if flush:
+                self.flushing = True
+        if flush:
+            flusher = threading.Thread(target=self.publish_deferred, name='mqtt-deferred-' + self.client_id)
+            flusher.daemon = True
+            flusher.start()
+        for listener in self.state_listeners:
+            listener(self)
+
+    def is_connecting(self):
+        return self.state == CONNECTING or self.state == RECONNECTING
+
+    # Waits until the gateway is no longer connecting, for at most timeout seconds (forever if None).
+    # Returns True if the gateway is not connecting anymore
+    def wait_for_connection(self, timeout = None):
+        deadline = None if timeout == None else time.time() + timeout
+        with self.state_condition:
+            while self.is_connecting():
+                if deadline == None:
+                    self.state_condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.state_condition.wait(remaining)
+        return True
+
     def thing_heartbeat(self, thing):
         logging.debug('thing_heartbeat start')
-        data = edge_util.create_thing_heartbeat(thing)
-        retval = self.send_message('Altizon/Datonis/' + self.client_id + '/heartbeat', data, 0)
+        retval = self.thing_heartbeat_async(thing).result()
         logging.debug('thing_heartbeat end')
         return retval
 
+    def thing_heartbeat_async(self, thing):
+        data = edge_util.create_thing_heartbeat(thing)
+        return self.send_message_async(self.get_topic('heartbeat'), data, 0)
+
     #send either a single or bulk events
     #see bulk events
     def thing_event(self, data):
         logging.debug('thing_event start')
-        retval = self.send_message('Altizon/Datonis/' + self.client_id + '/event', data, 1)
+        retval = self.thing_event_async(data).result()
         logging.debug('thing_event end')
         return retval
 
+    def thing_event_async(self, data):
+        if self.is_batched(data):
+            return self.batcher.add(data)
+        self.note_event(data)
+        future = self.enqueue('event', data)
+        if future != None:
+            return future
+        return self.send_message_async(self.get_topic('event'), data, 1)
+
     #takes in array of thing event messages
     # see create_thing_event
     def bulk_thing_event(self, data):
         logging.debug('bulk_event start')
-        bm = collections.OrderedDict()
-        bm['events'] = data
-        retval = self.thing_event(bm)
+        retval = self.bulk_thing_event_async(data).result()
         logging.debug('bulk_event end')
         return retval
 
+    def bulk_thing_event_async(self, data):
+        bm = collections.OrderedDict()
+        bm['events'] = data
+        return self.thing_event_async(bm)
+
     def subscribe_for_acks(self):
         if self.state == UNAUTHORISED:
             logging.error("Unauthorised to subscribe, Please check access key and secret key")
             return False
-        self.mqtt_client.subscribe('Altizon/Datonis/' + self.client_id + '/httpAck', 1)
+        self.mqtt_client.subscribe(self.get_topic('httpAck'), 1)
 
     def subscribe_for_instructions(self):
         if self.state == UNAUTHORISED:
             logging.error("Unauthorised to subscribe, Please check access key and secret key")
             return False
-        for thing in self.things:
-            self.subscribe_for_thing_instruction(thing)
+        if self.gateway_config.instruction_wildcard:
+            self.subscribe_topics([self.get_instruction_topic('+')], 'all things')
+            return
+        # Many topics go in one SUBSCRIBE packet, so that a large fleet needs few round trips on reconnect
+        things = list(self.things)
+        for i in range(0, len(things), self.SUBSCRIBE_BATCH_SIZE):
+            batch = things[i:i + self.SUBSCRIBE_BATCH_SIZE]
+            self.subscribe_topics([self.get_instruction_topic(thing.thing_key) for thing in batch], str(len(batch)) + ' things')
 
     def subscribe_for_thing_instruction(self,thing):
-        ret = self.mqtt_client.subscribe("Altizon/Datonis/" + self.gateway_config.access_key + "/thing/" + thing.thing_key + "/executeInstruction", 2)
+        if self.gateway_config.instruction_wildcard:
+            return
+        self.subscribe_topics([self.get_instruction_topic(thing.thing_key)], 'thing: ' + thing.name)
+
+    def remove_thing(self, thing_key):
+        thing = EdgeGateway.remove_thing(self, thing_key)
+        if thing != None and not self.gateway_config.instruction_wildcard and self.mqtt_client != None:
+            self.mqtt_client.unsubscribe(self.get_instruction_topic(thing_key))
+        return thing
+
+    # Topic for the messages sent by this gateway, name is e.g. 'event' or 'alert'
+    def get_topic(self, name):
+        return 'Altizon/Datonis/' + self.client_id + '/' + name
+
+    def get_instruction_topic(self, thing_key):
+        return "Altizon/Datonis/" + self.gateway_config.access_key + "/thing/" + thing_key + "/executeInstruction"
+
+    def subscribe_topics(self, topics, description):
+        if len(topics) == 0:
+            return
+        ret = self.mqtt_client.subscribe([(topic, 2) for topic in topics])
         if ret[0] == 0:
-            logging.info('Successfully subscribed for instructions for thing: ' + thing.name)
+            logging.info('Successfully subscribed for instructions for ' + description)
         else:
-            logging.warn('Could not subscribe for instructions for thing: ' + thing.name)
+            logging.warn('Could not subscribe for instructions for ' + description)
 
     def thing_register(self, thing):
         logging.debug('thing_register start')
-        data = edge_util.create_thing_register(thing)
-        retval = self.send_message('Altizon/Datonis/' + self.client_id + '/register', data, 1)
-        #Add thing so that we set up instruction listeners for this thing
-        if thing not in self.things:
-            self.things.append(thing)
-            self.subscribe_for_thing_instruction(thing)
+        retval = self.thing_register_async(thing).result()
         if retval == True:
             logging.debug("registered thing " + thing.name)
         else:
@@ -194,69 +508,214 @@ class EdgeGatewayMqtt(EdgeGateway):
         logging.debug('thing_register end')
         return retval
 
+    def thing_register_async(self, thing):
+        future = self.register_if_changed(thing, lambda data: self.send_message_async(self.get_topic('register'), data, 1))
+        #Add thing so that we set up instruction listeners for this thing
+        self.add_thing(thing)
+        return future
+
+    # Adds the thing to the registered things and subscribes for its instructions
+    def add_thing(self, thing):
+        if self.things.add(thing):
+            self.subscribe_for_thing_instruction(thing)
+
     def alert(self, thing_key, alert_message, alert_level = 0, alert_data = {}):
         logging.debug('alert start')
-        data = edge_util.create_alert(thing_key, alert_message, alert_level, alert_data)
-        retval = self.send_message('Altizon/Datonis/' + self.client_id + '/alert', data, 0)
+        retval = self.alert_async(thing_key, alert_message, alert_level, alert_data).result()
         logging.debug('alert end')
         return retval
 
+    def alert_async(self, thing_key, alert_message, alert_level = 0, alert_data = {}):
+        data = edge_util.create_alert(thing_key, alert_message, alert_level, alert_data)
+        future = self.enqueue('alert', data)
+        if future != None:
+            return future
+        return self.send_message_async(self.get_topic('alert'), data, 0)
+
+    def forward_async(self, kind, payload):
+        if kind == 'alert':
+            return self.send_message_async(self.get_topic('alert'), payload, 0)
+        return self.send_message_async(self.get_topic('event'), payload, 1)
+
     # Sends an instruction ack in the form of an alert to datonis
     def instruction_ack(self, alert_key, alert_message, alert_level = 0, alert_data = {}):
         logging.debug('instruction_ack start')
-        data = edge_util.create_instruction_alert(alert_key, alert_message, alert_level, alert_data)
-        retval = self.send_message('Altizon/Datonis/' + self.client_id + '/alert', data, 0)
+        retval = self.instruction_ack_async(alert_key, alert_message, alert_level, alert_data).result()
         logging.debug('instruction_alert end')
         return retval
 
+    def instruction_ack_async(self, alert_key, alert_message, alert_level = 0, alert_data = {}):
+        data = edge_util.create_instruction_alert(alert_key, alert_message, alert_level, alert_data)
+        return self.send_message_async(self.get_topic('alert'), data, 0, self.gateway_config.get_priority('instruction_ack'))
+
+    def get_ack_timeout(self):
+        if self.gateway_config.ack_timeout != None:
+            return self.gateway_config.ack_timeout
+        return self.HTTP_ACK_TIMEOUT_SECONDS
+
+    # Registers a waiter for the httpAck of the message signed with the specified hash.
+    # Identical payloads share a hash, so waiters for the same hash are completed in publish order
+    def register_ack(self, context, kind = None):
+        pending = PendingAck(context, kind)
+        with self.ack_lock:
+            self.pending_acks.setdefault(context, []).append(pending)
+        pending.timeout_call = self.ack_scheduler.schedule(self.get_ack_timeout(), lambda: self.expire_ack(pending))
+        return pending
+
+    def unregister_ack(self, pending):
+        with self.ack_lock:
+            waiters = self.pending_acks.get(pending.context)
+            if waiters == None or pending not in waiters:
+                return False
+            waiters.remove(pending)
+            if len(waiters) == 0:
+                del self.pending_acks[pending.context]
+        if pending.timeout_call != None:
+            self.ack_scheduler.cancel(pending.timeout_call)
+        return True
+
+    # Completes the oldest waiter for the specified hash, acks for unknown hashes are ignored
+    def complete_ack(self, context, code, content):
+        with self.ack_lock:
+            waiters = self.pending_acks.get(context)
+            if not waiters:
+                logging.debug('Received ack for unknown message: ' + str(context))
+                return False
+            pending = waiters.pop(0)
+            if len(waiters) == 0:
+                del self.pending_acks[context]
+        if pending.timeout_call != None:
+            self.ack_scheduler.cancel(pending.timeout_call)
+        t2 = edge_util.get_ts()
+        logging.info('Response from Datonis: ' + str(code) + ', time elapsed: ' + str(t2 - pending.sent_at) + ' milliseconds')
+        if content != None:
+            if code != 200 and len(content) > 0:
+                if type(content) is list:
+                    error_msgs = content
+                else:
+                    error_msgs = content.get("errors")
+
+                for em in error_msgs:
+                    logging.error('Error ' + em["code"] + ' : ' + em["message"])
+        self.finish_ack(pending, code == 200, code)
+        return True
+
+    # Completes the message, code is the http_code of its httpAck if one arrived
+    def finish_ack(self, pending, retval, code = None):
+        if pending.correlation_id != None:
+            tracing.emit(tracing.ACK, pending.correlation_id, accepted=retval)
+        if self.metrics != None:
+            self.metrics.completed(pending.kind, retval, clock() - pending.published_at)
+        pending.future.http_code = code
+        pending.future.set_result(retval)
+
+    # Called by the ack scheduler when the httpAck did not arrive in time. An ack that came in meanwhile
+    # already unregistered the waiter, then the message is not counted as timed out
+    def expire_ack(self, pending):
+        if self.unregister_ack(pending):
+            with self.ack_lock:
+                self.ack_timeouts += 1
+            logging.info('Timed out waiting for response from Datonis')
+            self.finish_ack(pending, False)
+
     def send_message(self, topic, payload, qos):
         logging.debug('send_message start')
-        while self.state == CONNECTING or self.state == RECONNECTING:
-            logging.info("Waiting for connection...")
-            time.sleep(3)
+        retval = self.send_message_async(topic, payload, qos).result()
+        logging.debug('send_message end')
+        return retval
+
+    # Publishes the message and returns a Future that resolves to True once Datonis acks it with 200.
+    # The future resolves to False on failure or if no ack arrives in time. priority is the lane of the
+    # message, by default the lane of the kind of message the topic is for. While the gateway is connecting
+    # the message is held and the Future returned right away, the caller never waits for the connection
+    def send_message_async(self, topic, payload, qos, priority = None):
+        with self.state_condition:
+            # Messages sent after the connection is back wait until the held ones are published, so they stay in order
+            if self.is_connecting() or len(self.deferred) > 0 or self.flushing:
+                return self.defer(topic, payload, qos, priority)
+        return self.publish_message(topic, payload, qos, priority)
+
+    # Holds the message until the gateway is connected, it fails after GatewayConfig.connection_timeout
+    # seconds if that is set. Called with state_condition held
+    def defer(self, topic, payload, qos, priority):
+        message = DeferredMessage(topic, payload, qos, priority)
+        self.deferred.append(message)
+        timeout = self.gateway_config.connection_timeout
+        if timeout != None:
+            message.timeout_call = self.ack_scheduler.schedule(timeout, lambda: self.expire_deferred(message))
+        return message.future
+
+    def expire_deferred(self, message):
+        with self.state_condition:
+            if message not in self.deferred:
+                return
+            self.deferred.remove(message)
+        logging.error("Timed out waiting for connection to the MQTT broker")
+        message.future.set_result(False)
+
+    # Publishes the held messages in order until none are left or the connection is lost again. flushing is
+    # only cleared once the last one was published, messages sent meanwhile are held and published here too
+    def publish_deferred(self):
+        while True:
+            with self.state_condition:
+                if self.is_connecting() or len(self.deferred) == 0:
+                    self.flushing = False
+                    return
+                message = self.deferred.popleft()
+            if message.timeout_call != None:
+                self.ack_scheduler.cancel(message.timeout_call)
+            try:
+                future = self.publish_message(message.topic, message.payload, message.qos, message.priority)
+            except:
+                logging.error('Publishing a held message failed', exc_info=True)
+                future = edge_util.completed_future(False)
+            edge_util.chain_future(future, message.future)
+
+    def publish_message(self, topic, payload, qos, priority):
         if self.state == UNAUTHORISED:
             logging.error("Unauthorised to send_message, Please check access key and secret key")
-            return False
-        t1 = edge_util.get_ts()
-        self.ack_lock.acquire()
-        self.ack_code = None
-        retval = False
-        data = json.dumps(payload, separators=(',', ':'))
-        h = edge_util.encode(str(self.gateway_config.secret_key),data)
-        payload['hash'] = h
-        payload['access_key'] = str(self.gateway_config.access_key)
-        payload['aliot_protocol_version'] = ALIOT_PROTOCOL_VERSION
-        data = json.dumps(payload, separators=(',', ':'))
+            return edge_util.completed_future(False)
+        if self.mqtt_client == None:
+            logging.error("Not connected, call connect before sending messages")
+            return edge_util.completed_future(False)
+        metrics = self.metrics
+        timer = metrics.timer() if metrics != None else None
+        correlation_id = tracing.take_correlation_id(payload) if tracing.hooks else None
+        data = edge_util.serialize(payload)
+        if timer != None:
+            timer.lap('serialize')
+        if correlation_id != None:
+            tracing.emit(tracing.SERIALIZE, correlation_id, size=len(data))
+        data, h = edge_util.sign_serialized(self.gateway_config.get_signer(), str(self.gateway_config.access_key), data, ALIOT_PROTOCOL_VERSION)
+        if timer != None:
+            timer.lap('sign')
+        if correlation_id != None:
+            tracing.emit(tracing.SIGN, correlation_id, hash=h)
+        codec = self.gateway_config.get_codec()
+        if codec != None:
+            data, content_encoding = codec.encode(data)
+            if content_encoding != None:
+                data = bytearray(data)
+        pending = self.register_ack(h, topic[topic.rfind('/') + 1:])
+        lane = self.gateway_config.get_priority(pending.kind) if priority == None else priority
+        pending.correlation_id = correlation_id
         try:
-            publish_response = self.mqtt_client.publish(topic, data, qos)
-            if publish_response[0] == 0:
-                counter = 0
-                while (self.ack_code == None) and (counter != self.HTTP_ACK_MAX_RETRIES):
-                    self.ack_lock.wait(10)
-                    if (self.ack_code != None and self.ack_context == h):
-                        break
-                    counter += 1
-                    self.ack_code = None
-                if self.ack_code == None:
-                    logging.info('Timed out waiting for response from Datonis')
-                else:
-                    t2 = edge_util.get_ts()
-                    logging.info('Response from Datonis: ' + str(self.ack_code) + ', time elapsed: ' + str(t2 - t1) + ' milliseconds' + ', retries: ' + str(counter))
-
-                    if self.ack_content != None:
-                        if self.ack_code != 200 and len(self.ack_content) > 0:
-                            parsed = self.ack_content
-                            if type(parsed) is list:
-                                error_msgs = parsed
-                            else:
-                                error_msgs = parsed.get("errors")
-
-                            for em in error_msgs:
-                                logging.error('Error ' + em["code"] + ' : ' + em["message"])
-                retval = self.ack_code == 200
+            if correlation_id != None:
+                tracing.current.correlation_id = correlation_id
+            try:
+                publish_response = self.mqtt_client.publish_in_lane(lane, topic, data, qos)
+            finally:
+                if correlation_id != None:
+                    tracing.current.correlation_id = None
+            if timer != None:
+                timer.lap('publish')
+                metrics.sent(pending.kind, len(data))
+            if publish_response[0] != 0:
+                logging.error('send_message failed, publish returned: ' + str(publish_response[0]))
+                if self.unregister_ack(pending):
+                    self.finish_ack(pending, False)
         except:
             logging.error('send_message failed', exc_info=True)
-        finally:
-            self.ack_lock.release()
-        logging.debug('send_message end')
-        return retval
+            if self.unregister_ack(pending):
+                self.finish_ack(pending, False)
+        return pending.future
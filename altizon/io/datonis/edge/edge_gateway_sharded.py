@@ -0,0 +1,222 @@
+import bisect
+import collections
+import hashlib
+import logging
+import time
+from concurrent.futures import Future
+
+from . import edge_util
+from .edge_gateway import EdgeGateway
+from .metrics import GatewayMetrics
+from .edge_gateway_mqtt import EdgeGatewayMqtt, CONNECTING, CONNECTED, DISCONNECTED, RECONNECTING, UNAUTHORISED
+
+# Maps keys to nodes so that adding or removing a node only moves the keys of that node
+class HashRing:
+    def __init__(self, nodes, replicas = 64):
+        self.ring = []
+        for node in nodes:
+            for i in range(replicas):
+                self.ring.append((self.hash(str(node) + '-' + str(i)), node))
+        self.ring.sort()
+        self.points = [point for point, node in self.ring]
+
+    def hash(self, key):
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+    def get(self, key):
+        index = bisect.bisect(self.points, self.hash(key)) % len(self.ring)
+        return self.ring[index][1]
+
+# An MQTT gateway spreading the things over several connections to the broker, each an EdgeGatewayMqtt with
+# its own client_id, network thread and socket. Every thing is always sent through the same connection,
+# chosen by a consistent hash of its thing_key, so the messages of a thing stay in order.
+# Batching, the outbox, the send queue and heartbeats work on the sharded gateway as a whole
+class ShardedEdgeGatewayMqtt(EdgeGateway):
+    def __init__(self, in_gateway_config, connections = None):
+        EdgeGateway.__init__(self, in_gateway_config)
+        if connections == None:
+            connections = in_gateway_config.mqtt_connections
+        # The shards share the config, so later changes to it apply to them as well. The registration cache
+        # is kept by this gateway, the shards must not open it too
+        self.shards = [EdgeGatewayMqtt(in_gateway_config, False) for i in range(max(1, connections))]
+        self.ring = HashRing(range(len(self.shards)))
+
+    def get_shard(self, key):
+        return self.shards[self.ring.get(str(key))]
+
+    # Called with (gateway, timestamp, thing_key, alert_key, instruction) by the shard the thing is on
+    @property
+    def instruction_handler(self):
+        return self.shards[0].instruction_handler
+
+    @instruction_handler.setter
+    def instruction_handler(self, handler):
+        for shard in self.shards:
+            shard.instruction_handler = handler
+
+    @property
+    def instruction_result_handler(self):
+        return self.shards[0].instruction_result_handler
+
+    @instruction_result_handler.setter
+    def instruction_result_handler(self, handler):
+        for shard in self.shards:
+            shard.instruction_result_handler = handler
+
+    # UNAUTHORISED if any connection is, CONNECTED once all are, otherwise the state of the connections
+    # that are not connected
+    @property
+    def state(self):
+        states = [shard.state for shard in self.shards]
+        if UNAUTHORISED in states:
+            return UNAUTHORISED
+        if all(state == CONNECTED for state in states):
+            return CONNECTED
+        if RECONNECTING in states:
+            return RECONNECTING
+        if CONNECTING in states:
+            return CONNECTING
+        return DISCONNECTED
+
+    def connect(self):
+        retval = True
+        for shard in self.shards:
+            if not shard.connect():
+                retval = False
+        return retval
+
+    def is_connecting(self):
+        return any(shard.is_connecting() for shard in self.shards)
+
+    # Waits until no connection is connecting anymore, for at most timeout seconds (forever if None)
+    def wait_for_connection(self, timeout = None):
+        deadline = None if timeout == None else time.time() + timeout
+        for shard in self.shards:
+            remaining = None if deadline == None else max(0, deadline - time.time())
+            if not shard.wait_for_connection(remaining):
+                return False
+        return True
+
+    def thing_register(self, thing):
+        logging.debug('thing_register start')
+        retval = self.thing_register_async(thing).result()
+        if retval == True:
+            logging.debug("registered thing " + thing.name)
+        else:
+            logging.error("registration failed for thing " + thing.name + ", Return code: " + str(retval))
+        logging.debug('thing_register end')
+        return retval
+
+    def thing_register_async(self, thing):
+        shard = self.get_shard(thing.thing_key)
+        self.things.add(thing)
+        shard.add_thing(thing)
+        return self.register_if_changed(thing, lambda data: shard.send_message_async(shard.get_topic('register'), data, 1))
+
+    def remove_thing(self, thing_key):
+        self.get_shard(thing_key).remove_thing(thing_key)
+        return EdgeGateway.remove_thing(self, thing_key)
+
+    def thing_heartbeat(self, thing):
+        return self.thing_heartbeat_async(thing).result()
+
+    def thing_heartbeat_async(self, thing):
+        return self.get_shard(thing.thing_key).thing_heartbeat_async(thing)
+
+    def thing_event(self, data):
+        logging.debug('thing_event start')
+        retval = self.thing_event_async(data).result()
+        logging.debug('thing_event end')
+        return retval
+
+    def thing_event_async(self, data):
+        if self.is_batched(data):
+            return self.batcher.add(data)
+        self.note_event(data)
+        future = self.enqueue('event', data)
+        if future != None:
+            return future
+        return self.forward_async('event', data)
+
+    def bulk_thing_event(self, data):
+        return self.bulk_thing_event_async(data).result()
+
+    def bulk_thing_event_async(self, data):
+        bm = collections.OrderedDict()
+        bm['events'] = data
+        return self.thing_event_async(bm)
+
+    def alert(self, thing_key, alert_message, alert_level = 0, alert_data = {}):
+        return self.alert_async(thing_key, alert_message, alert_level, alert_data).result()
+
+    def alert_async(self, thing_key, alert_message, alert_level = 0, alert_data = {}):
+        data = edge_util.create_alert(thing_key, alert_message, alert_level, alert_data)
+        future = self.enqueue('alert', data)
+        if future != None:
+            return future
+        return self.forward_async('alert', data)
+
+    # Bulk messages are split by shard, the result is True if all the parts were accepted
+    def forward_async(self, kind, payload):
+        if kind == 'alert':
+            return self.get_shard(payload['alert'].get('thing_key')).forward_async(kind, payload)
+        if 'events' not in payload:
+            return self.get_shard(payload.get('thing_key')).forward_async(kind, payload)
+        parts = collections.OrderedDict()
+        for event in payload['events']:
+            parts.setdefault(self.ring.get(str(event.get('thing_key'))), []).append(event)
+        if len(parts) == 1:
+            index, events = next(iter(parts.items()))
+            return self.shards[index].forward_async(kind, payload)
+        futures = collections.OrderedDict()
+        for index, events in parts.items():
+            bm = collections.OrderedDict()
+            bm['events'] = events
+            futures[index] = self.shards[index].forward_async(kind, bm)
+        future = Future()
+        future.set_running_or_notify_cancel()
+
+        def complete(f):
+            retval = all(r == True for r in f.result().values())
+            # Rejected as a whole only if every failed part was rejected, otherwise it is worth sending again
+            failed = [part for index, part in futures.items() if f.result()[index] != True]
+            if len(failed) > 0 and all(edge_util.is_rejected(part) for part in failed):
+                future.http_code = failed[0].http_code
+            future.set_result(retval)
+        edge_util.gather_results(futures).add_done_callback(complete)
+        return future
+
+    def instruction_ack(self, alert_key, alert_message, alert_level = 0, alert_data = {}):
+        return self.instruction_ack_async(alert_key, alert_message, alert_level, alert_data).result()
+
+    def instruction_ack_async(self, alert_key, alert_message, alert_level = 0, alert_data = {}):
+        return self.get_shard(alert_key).instruction_ack_async(alert_key, alert_message, alert_level, alert_data)
+
+    # The gauges of the gateway as a whole are recorded once, the connection metrics per shard by client_id
+    def enable_metrics(self, registry = None, port = None, host = '127.0.0.1'):
+        registry = EdgeGateway.enable_metrics(self, registry, port, host)
+        for shard in self.shards:
+            metrics = GatewayMetrics(registry, **shard.get_metrics_labels())
+            shard.register_connection_gauges(metrics)
+            shard.metrics = metrics
+        return registry
+
+    # Aggregated counters of all connections, with the counters of each connection under 'shards'
+    def stats(self):
+        shards = []
+        for shard in self.shards:
+            with shard.ack_lock:
+                pending_acks = sum(len(waiters) for waiters in shard.pending_acks.values())
+            shards.append({
+                'client_id': shard.client_id,
+                'state': shard.state,
+                'things': len(shard.things),
+                'pending_acks': pending_acks,
+                'ack_timeouts': shard.ack_timeouts,
+                'instructions_executed': shard.instruction_pool.executed if shard.instruction_pool != None else 0,
+            })
+        stats = {'connections': len(shards), 'connected': sum(1 for s in shards if s['state'] == CONNECTED)}
+        for key in ('things', 'pending_acks', 'ack_timeouts', 'instructions_executed'):
+            stats[key] = sum(s[key] for s in shards)
+        stats['shards'] = shards
+        return stats
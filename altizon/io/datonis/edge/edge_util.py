@@ -1,16 +1,161 @@
-import copy
 import hashlib
 import hmac
+import json
 import logging
+import threading
 import time
 import collections
 import sys
+from concurrent.futures import Future
+
+from . import tracing
 
 is_python3 = (sys.version[0] == '3')
+supports_asyncio = (sys.version_info >= (3, 5))
+
+# Signs payloads with HMAC-SHA256. The keyed HMAC state is computed once and copied for every message
+class Signer:
+    def __init__(self, secret_key):
+        self.secret_key = secret_key
+        self.keyed_hmac = hmac.new(bytes(secret_key.encode('utf-8')), digestmod=hashlib.sha256)
+
+    def sign(self, payload):
+        h = self.keyed_hmac.copy()
+        h.update(payload.encode('utf-8'))
+        return h.hexdigest()
 
+    def sign_many(self, payloads):
+        keyed_hmac = self.keyed_hmac
+        signatures = []
+        for payload in payloads:
+            h = keyed_hmac.copy()
+            h.update(payload.encode('utf-8'))
+            signatures.append(h.hexdigest())
+        return signatures
+
+# Signs a single payload, the gateways keep a Signer in their GatewayConfig for the messages they send
 def encode(secret_key, payload):
-    dig = hmac.new(bytes(secret_key.encode('utf-8')), msg=payload.encode('utf-8'), digestmod=hashlib.sha256).hexdigest()
-    return dig
+    return Signer(secret_key).sign(payload)
+
+# Serializes the payload once, signs it and splices the envelope fields into the encoded JSON object.
+# Returns the message and its hash, the result is the same as adding hash, access_key and
+# aliot_protocol_version to the payload and serializing it again, but the payload is left untouched
+def sign_message(signer, access_key, payload, protocol_version):
+    return sign_serialized(signer, access_key, serialize(payload), protocol_version)
+
+# Encodes a payload as compact JSON, the form that gets signed
+def serialize(payload):
+    return json.dumps(payload, separators=(',', ':'))
+
+# Same as sign_message for a payload that was already serialized with serialize
+def sign_serialized(signer, access_key, data, protocol_version):
+    h = signer.sign(data)
+    envelope = '"hash":"' + h + '","access_key":' + json.dumps(access_key) + ',"aliot_protocol_version":' + json.dumps(protocol_version) + '}'
+    if data == '{}':
+        return '{' + envelope, h
+    return data[:-1] + ',' + envelope, h
+
+# Finds the "name":"value" member of a JSON object in the encoded text, it must occur exactly once and
+# its value must not contain escapes. Returns (start, end, value) or None
+def find_string_member(text, name):
+    key = '"' + name + '":"'
+    start = text.find(key)
+    if start < 0 or text.find(key, start + 1) >= 0:
+        return None
+    value_start = start + len(key)
+    value_end = text.find('"', value_start)
+    if value_end < 0 or text.find('\\', value_start, value_end) >= 0:
+        return None
+    return start, value_end + 1, text[value_start:value_end]
+
+# Removes a member found by find_string_member together with its separating comma
+def cut_member(text, start, end):
+    if text[end:end + 1] == ',':
+        return text[:start] + text[end + 1:]
+    if text[start - 1:start] == ',':
+        return text[:start - 1] + text[end:]
+    return text[:start] + text[end:]
+
+# Excises the hash and access_key members from a signed message (as sent by Datonis or sign_message)
+# without decoding it. Returns the signed remainder and the hash, or None if they could not be located
+def excise_signature(text):
+    found = find_string_member(text, 'hash')
+    if found == None:
+        return None
+    text = cut_member(text, found[0], found[1])
+    h = found[2]
+    found = find_string_member(text, 'access_key')
+    if found == None:
+        return None
+    return cut_member(text, found[0], found[1]), h
+
+# True if the encoded JSON has no whitespace after separators
+def is_compact(text):
+    return ', "' not in text and '": ' not in text
+
+# True if the encoded JSON is byte for byte what serialize would produce for it: compact, pure ASCII (json.dumps
+# escapes everything else) and without escapes, which other encoders may write differently (e.g. \/ or \u00E9)
+def is_canonical(text):
+    if not is_compact(text) or '\\' in text:
+        return False
+    try:
+        text.encode('ascii')
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return False
+    return True
+
+compare_digest = getattr(hmac, 'compare_digest', lambda a, b: a == b)
+
+# Returns a Future that is already resolved with the specified value
+def completed_future(value):
+    future = Future()
+    future.set_running_or_notify_cancel()
+    future.set_result(value)
+    return future
+
+# True if Datonis answered the message of the future with a code that sending it again will not change,
+# the gateways set future.http_code from the httpAck or the HTTP response. Timeouts, connection errors,
+# throttling (429) and server errors (5xx) are not rejections
+def is_rejected(future):
+    code = getattr(future, 'http_code', None)
+    return code != None and code != 200 and code != 429 and code < 500
+
+# Completes target with the result (and http_code) of source once source is done
+def chain_future(source, target):
+    def done(f):
+        target.http_code = getattr(f, 'http_code', None)
+        if f.cancelled():
+            target.set_result(False)
+        elif f.exception() != None:
+            target.set_exception(f.exception())
+        else:
+            target.set_result(f.result())
+    source.add_done_callback(done)
+
+# Returns a Future that resolves to an OrderedDict with the results of the futures in the specified
+# OrderedDict, under the same keys. A future that failed or was cancelled gives False
+def gather_results(futures):
+    gathered = Future()
+    gathered.set_running_or_notify_cancel()
+    results = collections.OrderedDict((key, None) for key in futures)
+    lock = threading.Lock()
+    remaining = [len(futures)]
+    if len(futures) == 0:
+        gathered.set_result(results)
+        return gathered
+
+    def complete(key, f):
+        retval = not f.cancelled() and f.exception() == None and f.result()
+        with lock:
+            results[key] = retval
+            remaining[0] -= 1
+            done = remaining[0] == 0
+        if done:
+            gathered.set_result(results)
+
+    for key, future in futures.items():
+        future.add_done_callback(lambda f, key=key: complete(key, f))
+    return gathered
 
 def get_str(msg):
     if is_python3:
@@ -36,6 +181,8 @@ def create_thing_event(thing,data_value, waypoint = None, ts = None):
         data['timestamp'] = get_ts()
     else:
         data['timestamp'] = ts
+    if tracing.hooks:
+        tracing.on_build(data, 'event')
     logging.debug('create_thing_event end')
     return data
 
@@ -48,18 +195,21 @@ def create_thing_heartbeat(thing, ts = None):
         data['timestamp'] = get_ts()
     else:
         data['timestamp'] = ts
+    if tracing.hooks:
+        tracing.on_build(data, 'heartbeat')
     logging.debug('create_thing_heartbeat end')
     return data
 
 def create_thing_register(thing, ts = None):
     logging.debug('create_thing_register start')
-    #make a copy of thing and add gateway info to it.
-    data = copy.deepcopy(thing.__dict__)
-    data = collections.OrderedDict(data)
+    #make a copy of thing and add gateway info to it, the nested values are only serialized so they are not copied
+    data = collections.OrderedDict(thing.__dict__)
     if ts == None:
         data['timestamp'] = get_ts()
     else:
         data['timestamp'] = ts
+    if tracing.hooks:
+        tracing.on_build(data, 'register')
     logging.debug('create_thing_register end')
     return data
 
@@ -76,6 +226,8 @@ def create_alert(thing_key, alert_msg, alert_level = 0, alert_data = {}, ts = No
     else:
         alert['timestamp'] = ts
     data['alert'] = alert
+    if tracing.hooks:
+        tracing.on_build(data, 'alert')
     logging.debug('create_alert end')
     return data
 
@@ -92,5 +244,7 @@ def create_instruction_alert(alert_key, alert_msg, alert_level = 0, alert_data =
     else:
         alert['timestamp'] = ts
     data['alert'] = alert
+    if tracing.hooks:
+        tracing.on_build(data, 'instruction_ack')
     logging.debug('create_instruction_alert end')
     return data
@@ -0,0 +1,85 @@
+import json
+import logging
+import threading
+from concurrent.futures import Future
+
+from .deadline_scheduler import DeadlineScheduler
+
+# Collects single thing events and sends them as one bulk_thing_event message.
+# A batch is sent when it holds max_events events, when its events reach max_bytes of JSON
+# (only measured if max_bytes is set) or linger_seconds after its first event, whichever comes first.
+# add returns a Future per event which resolves to the result of the bulk message carrying it
+class EventBatcher:
+    def __init__(self, gateway, max_events = 100, max_bytes = None, linger_seconds = 0.1):
+        self.gateway = gateway
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.linger_seconds = linger_seconds
+        self.lock = threading.Lock()
+        self.events = []
+        self.futures = []
+        self.size = 0
+        self.linger_call = None
+        self.scheduler = DeadlineScheduler('event-batcher')
+        # Counters
+        self.batches = 0
+        self.batched_events = 0
+
+    def add(self, event):
+        future = Future()
+        future.set_running_or_notify_cancel()
+        batch = None
+        with self.lock:
+            self.events.append(event)
+            self.futures.append(future)
+            if self.max_bytes != None:
+                self.size += len(json.dumps(event, separators=(',', ':'))) + 1
+            if len(self.events) >= self.max_events or (self.max_bytes != None and self.size >= self.max_bytes):
+                batch = self.take()
+            elif len(self.events) == 1:
+                self.linger_call = self.scheduler.schedule(self.linger_seconds, self.flush)
+        if batch != None:
+            self.send(batch)
+        return future
+
+    # Sends the events collected so far
+    def flush(self):
+        with self.lock:
+            if len(self.events) == 0:
+                return
+            batch = self.take()
+        self.send(batch)
+
+    # Number of events waiting to be sent
+    def pending(self):
+        with self.lock:
+            return len(self.events)
+
+    def take(self):
+        batch = (self.events, self.futures)
+        self.events = []
+        self.futures = []
+        self.size = 0
+        if self.linger_call != None:
+            self.scheduler.cancel(self.linger_call)
+            self.linger_call = None
+        return batch
+
+    def send(self, batch):
+        events, futures = batch
+        self.batches += 1
+        self.batched_events += len(events)
+        logging.debug('Sending batch of ' + str(len(events)) + ' events')
+        try:
+            bulk_future = self.gateway.bulk_thing_event_async(events)
+        except:
+            logging.error('Sending batch failed', exc_info=True)
+            for future in futures:
+                future.set_result(False)
+            return
+
+        def complete(f):
+            retval = (f.exception() == None and f.result() == True)
+            for future in futures:
+                future.set_result(retval)
+        bulk_future.add_done_callback(complete)
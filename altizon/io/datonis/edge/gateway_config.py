@@ -1,5 +1,11 @@
 from .edge_gateway_http import EdgeGatewayHttp
 from .edge_gateway_mqtt import EdgeGatewayMqtt
+from .edge_gateway_sharded import ShardedEdgeGatewayMqtt
+from . import edge_util
+from .codec import Codec
+from . import priority_lanes
+from .priority_lanes import LaneScheduler
+from .reconnect_policy import ReconnectPolicy
 
 class GatewayConfig:
     def __init__(self, in_access_key, in_secret_key, in_protocol, in_cert_path=None, in_api_host=None, in_api_port=None):
@@ -16,11 +22,89 @@ class GatewayConfig:
             self.api_host = ('api.datonis.io' if in_api_host == None else in_api_host)
             self.api_port = in_api_port
         self.additional_attributes = {}
+        # Seconds a message sent while the MQTT connection is being (re)established is held before it fails,
+        # None holds it until the gateway is connected. Senders never wait for the connection
+        self.connection_timeout = None
+        # Seconds an MQTT send waits for its ack from Datonis, None uses EdgeGatewayMqtt.HTTP_ACK_TIMEOUT_SECONDS (10)
+        self.ack_timeout = None
+        # Number of workers executing instructions in parallel (instructions for one thing always run in order),
+        # in child processes instead of threads if instruction_processes is set, see InstructionPool
+        self.instruction_workers = 1
+        self.instruction_processes = False
+        # Number of alert_keys of dispatched MQTT instructions remembered for dropping redelivered instructions,
+        # and the seconds each is remembered for (None until evicted). 0 disables the check
+        self.instruction_dedup_size = 1024
+        self.instruction_dedup_ttl = 3600
+        # Subscribe once to the instructions of all things of the access key with a wildcard topic instead of
+        # once per registered thing, instructions for things not registered with the gateway are ignored
+        self.instruction_wildcard = False
+        # File remembering what was registered for each thing, registrations of unchanged things are skipped
+        # (reported as successful) when it is set, see RegistrationCache
+        self.registration_cache_path = None
+        # Delays between MQTT reconnect attempts, see ReconnectPolicy
+        self.reconnect_min_delay = 1.0
+        self.reconnect_max_delay = 120.0
+        self.reconnect_jitter = True
+        # Number of MQTT connections create_gateway opens, things are spread over them by thing_key,
+        # see ShardedEdgeGatewayMqtt
+        self.mqtt_connections = 1
+        # Compression of messages of at least compression_threshold bytes, 'gzip' or 'zlib' (None sends them as is).
+        # The endpoint must accept compressed messages, see Codec
+        self.compression = None
+        self.compression_level = 6
+        self.compression_threshold = 1024
+        # Lane (priority_lanes.HIGH, NORMAL or LOW) of each kind of message, overriding DEFAULT_PRIORITIES, and how
+        # the lanes share the send queue and the HTTP workers: 'strict' or 'weighted' by priority_weights
+        self.priorities = {}
+        self.priority_scheduling = 'strict'
+        self.priority_weights = (8, 4, 1)
+        self.signer = None
+        self.codec = None
         if in_cert_path != None:
             self.cert_path = in_cert_path
 
+    # Returns the Signer for the secret key, it is rebuilt if the secret key is changed
+    def get_signer(self):
+        if self.signer == None or self.signer.secret_key != str(self.secret_key):
+            self.signer = edge_util.Signer(str(self.secret_key))
+        return self.signer
+
+    # Returns a new ReconnectPolicy for a connection, as per the reconnect settings
+    def create_reconnect_policy(self):
+        return ReconnectPolicy(self.reconnect_min_delay, self.reconnect_max_delay, jitter=self.reconnect_jitter)
+
+    # Returns the Codec for the compression settings, or None if messages are sent uncompressed
+    def get_codec(self):
+        if self.compression == None:
+            return None
+        codec = self.codec
+        if codec == None or (codec.name, codec.level, codec.threshold) != (self.compression, self.compression_level, self.compression_threshold):
+            codec = self.codec = Codec(self.compression, self.compression_level, self.compression_threshold)
+        return codec
+
+    # Returns the lane for messages of kind, e.g. 'alert' or 'event'
+    def get_priority(self, kind):
+        priority = self.priorities.get(kind)
+        if priority == None:
+            priority = priority_lanes.DEFAULT_PRIORITIES.get(kind, priority_lanes.NORMAL)
+        return priority
+
+    # Returns a new LaneScheduler as per the priority settings
+    def create_lane_scheduler(self):
+        return LaneScheduler(self.priority_scheduling, self.priority_weights)
+
     def create_gateway(self):
         if self.protocol == 'mqtt' or self.protocol == 'mqtts':
+            if self.mqtt_connections > 1:
+                return ShardedEdgeGatewayMqtt(self)
             return EdgeGatewayMqtt(self)
         else:
             return EdgeGatewayHttp(self)
+
+    # Same as create_gateway, but returns the asyncio version of the gateway (Python 3.5+ only)
+    def create_async_gateway(self):
+        from .edge_gateway_async import AsyncEdgeGatewayHttp, AsyncEdgeGatewayMqtt
+        if self.protocol == 'mqtt' or self.protocol == 'mqtts':
+            return AsyncEdgeGatewayMqtt(self)
+        else:
+            return AsyncEdgeGatewayHttp(self)
@@ -0,0 +1,86 @@
+import logging
+import threading
+
+from .deadline_scheduler import clock
+
+# Sends heartbeats for all the things registered with the gateway from a single timer thread.
+# A thing gets a heartbeat when nothing was sent for it for interval seconds, so things that send events
+# regularly never need one. The fleet is checked TICKS_PER_INTERVAL times per interval and the due heartbeats
+# are sent without waiting for each other, at most max_inflight at a time
+class HeartbeatScheduler:
+    TICKS_PER_INTERVAL = 4
+
+    def __init__(self, gateway, interval = 60, max_inflight = 100):
+        self.gateway = gateway
+        self.interval = interval
+        self.inflight = threading.Semaphore(max_inflight)
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        # Counters
+        self.ticks = 0
+        self.sent = 0
+        self.failed = 0
+        self.suppressed = 0
+        self.thread = threading.Thread(target=self.run, name='heartbeat-scheduler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Records that a message was sent for the things of the event (single or bulk)
+    def touch(self, data):
+        now = clock()
+        if 'events' in data:
+            for event in data['events']:
+                self.touch_thing(event.get('thing_key'), now)
+        else:
+            self.touch_thing(data.get('thing_key'), now)
+
+    def touch_thing(self, thing_key, now):
+        metadata = self.gateway.things.get_metadata(thing_key)
+        if metadata != None:
+            metadata['last_sent'] = now
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(float(self.interval) / self.TICKS_PER_INTERVAL):
+            try:
+                self.tick()
+            except:
+                logging.error('Sending heartbeats failed', exc_info=True)
+
+    def tick(self):
+        self.ticks += 1
+        now = clock()
+        due = []
+        things = self.gateway.things
+        for thing in things:
+            metadata = things.get_metadata(thing.thing_key)
+            if metadata == None:
+                continue
+            last_sent = metadata.get('last_sent')
+            if last_sent == None or now - last_sent >= self.interval:
+                metadata['last_sent'] = now
+                due.append(thing)
+        with self.lock:
+            self.suppressed += len(things) - len(due)
+        if len(due) > 0:
+            logging.debug('Sending heartbeats for ' + str(len(due)) + ' things')
+        for thing in due:
+            if self.stopped.is_set():
+                return
+            self.inflight.acquire()
+            try:
+                future = self.gateway.thing_heartbeat_async(thing)
+            except:
+                logging.error('Sending heartbeat failed for thing: ' + thing.name, exc_info=True)
+                self.complete(False)
+                continue
+            future.add_done_callback(lambda f: self.complete(not f.cancelled() and f.exception() == None and f.result() == True))
+
+    def complete(self, retval):
+        with self.lock:
+            self.sent += 1
+            if not retval:
+                self.failed += 1
+        self.inflight.release()
@@ -0,0 +1,100 @@
+import logging
+import threading
+import zlib
+
+from . import edge_util
+from .deadline_scheduler import clock
+
+if edge_util.is_python3:
+    import queue as Queue
+else:
+    import Queue as Queue
+
+# Runs the instruction handler in the child process, where the gateway is not available
+def run_in_process(handler, timestamp, thing_key, alert_key, instruction):
+    return handler(None, timestamp, thing_key, alert_key, instruction)
+
+# A worker executing the instructions of the things hashed to it, one at a time and in arrival order
+class Lane:
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.queue = Queue.Queue()
+        self.process_executor = None
+        if pool.use_processes:
+            from concurrent.futures import ProcessPoolExecutor
+            self.process_executor = ProcessPoolExecutor(max_workers=1)
+        self.thread = threading.Thread(target=self.run, name='instruction-worker-' + str(index))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            queued_at, args = self.queue.get()
+            started_at = clock()
+            ok = True
+            try:
+                self.execute(args)
+            except:
+                ok = False
+                logging.error('instruction_handler failed', exc_info=True)
+            self.pool.record(started_at - queued_at, clock() - started_at, ok)
+
+    def execute(self, args):
+        gateway = self.pool.gateway
+        handler = gateway.instruction_handler
+        if handler == None:
+            logging.warn('Received instruction for thing: ' + str(args[1]) + '. But, no handler set for executing it. It will be ignored')
+            return
+        if self.process_executor == None:
+            handler(gateway, *args)
+        else:
+            result = self.process_executor.submit(run_in_process, handler, *args).result()
+            if gateway.instruction_result_handler != None:
+                gateway.instruction_result_handler(gateway, args[0], args[1], args[2], args[3], result)
+
+# Executes instructions on a pool of workers. Instructions for the same thing_key always go to the same
+# worker so they run in order, while instructions for different things run in parallel.
+# With use_processes the handler runs in a child process per worker and must be picklable (a module level
+# function); it gets None instead of the gateway and its return value is passed to
+# gateway.instruction_result_handler(gateway, timestamp, thing_key, alert_key, instruction, result)
+class InstructionPool:
+    def __init__(self, gateway, workers = 1, use_processes = False):
+        self.gateway = gateway
+        self.use_processes = use_processes
+        self.lock = threading.Lock()
+        # Counters, latencies are in seconds
+        self.executed = 0
+        self.failed = 0
+        self.total_wait = 0.0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.lanes = [Lane(self, i) for i in range(max(1, workers))]
+
+    def submit(self, timestamp, thing_key, alert_key, instruction):
+        lane = self.lanes[zlib.crc32(thing_key.encode('utf-8')) % len(self.lanes)]
+        lane.queue.put((clock(), (timestamp, thing_key, alert_key, instruction)))
+
+    def record(self, wait, latency, ok):
+        with self.lock:
+            self.executed += 1
+            if not ok:
+                self.failed += 1
+            self.total_wait += wait
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    # Number of instructions waiting for a worker
+    def queue_depth(self):
+        return sum(lane.queue.qsize() for lane in self.lanes)
+
+    def stats(self):
+        with self.lock:
+            executed = self.executed
+            return {
+                'queue_depth': self.queue_depth(),
+                'executed': executed,
+                'failed': self.failed,
+                'avg_wait_ms': (self.total_wait * 1000 / executed) if executed > 0 else 0.0,
+                'avg_latency_ms': (self.total_latency * 1000 / executed) if executed > 0 else 0.0,
+                'max_latency_ms': self.max_latency * 1000,
+            }
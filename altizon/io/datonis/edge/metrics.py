@@ -0,0 +1,219 @@
+import bisect
+import collections
+import logging
+import threading
+
+from . import edge_util
+from .deadline_scheduler import clock
+
+if edge_util.is_python3:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+else:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+# Upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    escaped = [k + '="' + str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for k, v in labels]
+    return '{' + ','.join(escaped) + '}'
+
+def format_value(value):
+    if isinstance(value, float) and value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+# A value that only goes up. With fn, the value is read from fn() when the metrics are rendered
+class Counter:
+    TYPE = 'counter'
+
+    def __init__(self, labels, fn = None):
+        self.labels = labels
+        self.fn = fn
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount = 1):
+        with self.lock:
+            self.value += amount
+
+    def get(self):
+        if self.fn != None:
+            return self.fn()
+        return self.value
+
+    def samples(self, name):
+        return [(name, self.labels, self.get())]
+
+# A value that goes up and down. With fn, the value is read from fn() when the metrics are rendered
+class Gauge(Counter):
+    TYPE = 'gauge'
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+# Counts observed values (usually seconds) in buckets of upper bounds
+class Histogram:
+    TYPE = 'histogram'
+
+    def __init__(self, labels, buckets = DEFAULT_BUCKETS):
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # One count per bucket plus one for the values above the last bound, not cumulative
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self, name):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+            count = self.count
+        samples = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            samples.append((name + '_bucket', self.labels + (('le', format_value(float(bound))),), cumulative))
+        samples.append((name + '_bucket', self.labels + (('le', '+Inf'),), count))
+        samples.append((name + '_sum', self.labels, total))
+        samples.append((name + '_count', self.labels, count))
+        return samples
+
+# Holds named counters, gauges and histograms, each with any number of label sets, and renders them in the
+# Prometheus text format. Asking for a metric that exists returns it, so gateways can share a registry
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name -> (metric class, help, OrderedDict of labels -> metric)
+        self.families = collections.OrderedDict()
+        self.server = None
+
+    def get(self, cls, name, help, labels, create):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            family = self.families.get(name)
+            if family == None:
+                family = self.families[name] = (cls, help, collections.OrderedDict())
+            elif family[0] is not cls:
+                raise ValueError('Metric ' + name + ' is already registered as a ' + family[0].TYPE)
+            metric = family[2].get(key)
+            if metric == None:
+                metric = family[2][key] = create(key)
+            return metric
+
+    def counter(self, name, help, fn = None, **labels):
+        counter = self.get(Counter, name, help, labels, lambda key: Counter(key, fn))
+        if fn != None:
+            counter.fn = fn
+        return counter
+
+    def gauge(self, name, help, fn = None, **labels):
+        gauge = self.get(Gauge, name, help, labels, lambda key: Gauge(key, fn))
+        if fn != None:
+            gauge.fn = fn
+        return gauge
+
+    def histogram(self, name, help, buckets = DEFAULT_BUCKETS, **labels):
+        return self.get(Histogram, name, help, labels, lambda key: Histogram(key, buckets))
+
+    # Returns all metrics in the Prometheus text exposition format
+    def render(self):
+        with self.lock:
+            families = [(name, cls, help, list(metrics.values())) for name, (cls, help, metrics) in self.families.items()]
+        lines = []
+        for name, cls, help, metrics in families:
+            lines.append('# HELP ' + name + ' ' + help)
+            lines.append('# TYPE ' + name + ' ' + cls.TYPE)
+            for metric in metrics:
+                try:
+                    samples = metric.samples(name)
+                except:
+                    logging.error('Reading metric ' + name + ' failed', exc_info=True)
+                    continue
+                for sample_name, labels, value in samples:
+                    lines.append(sample_name + format_labels(labels) + ' ' + format_value(value))
+        return '\n'.join(lines) + '\n'
+
+    # Serves the metrics at http://host:port/metrics from a daemon thread, returns the server
+    def serve(self, port, host = '127.0.0.1'):
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug('metrics endpoint: ' + (format % args))
+
+        self.server = HTTPServer((host, port), MetricsHandler)
+        thread = threading.Thread(target=self.server.serve_forever, name='metrics-endpoint')
+        thread.daemon = True
+        thread.start()
+        return self.server
+
+# Times consecutive stages of sending one message
+class StageTimer:
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.last = clock()
+
+    # Records the time since the previous lap as the duration of the stage
+    def lap(self, stage):
+        now = clock()
+        self.metrics.observe(stage, now - self.last)
+        self.last = now
+
+# The metrics a gateway records, labels (e.g. the client_id) are added to all of them
+class GatewayMetrics:
+    def __init__(self, registry, **labels):
+        self.registry = registry
+        self.labels = labels
+
+    def counter(self, name, help, **labels):
+        labels.update(self.labels)
+        return self.registry.counter(name, help, **labels)
+
+    def gauge(self, name, help, fn):
+        return self.registry.gauge(name, help, fn, **self.labels)
+
+    def timer(self):
+        return StageTimer(self)
+
+    # stage is serialize, sign, publish or ack
+    def observe(self, stage, seconds):
+        self.registry.histogram('datonis_' + stage + '_seconds', 'Seconds spent to ' + stage + ' a message', **self.labels).observe(seconds)
+
+    def sent(self, kind, size):
+        self.counter('datonis_messages_sent_total', 'Messages sent', kind=kind).inc()
+        self.counter('datonis_bytes_sent_total', 'Bytes of messages sent, after compression', kind=kind).inc(size)
+
+    # Records the result of a message, seconds is the time from publishing it to getting the result
+    def completed(self, kind, accepted, seconds = None):
+        if accepted:
+            self.counter('datonis_messages_acked_total', 'Messages accepted by Datonis', kind=kind).inc()
+        else:
+            self.counter('datonis_messages_failed_total', 'Messages rejected, failed or not acknowledged in time', kind=kind).inc()
+        if seconds != None:
+            self.observe('ack', seconds)
+
+    def retried(self, count = 1):
+        self.counter('datonis_messages_retried_total', 'Messages sent again after a failure').inc(count)
@@ -0,0 +1,417 @@
+import collections
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from . import edge_util
+from .deadline_scheduler import clock
+
+SEGMENT_SUFFIX = '.seg'
+CHECKPOINT_FILE = 'checkpoint'
+# Messages Datonis rejected, one stored record per line
+DEAD_LETTER_FILE = 'dead-letter.jsonl'
+
+# Every record is prefixed with its length and CRC32, a zero length marks the end of a segment
+HEADER = struct.Struct('>II')
+
+FSYNC_ALWAYS = 'always'
+FSYNC_INTERVAL = 'interval'
+FSYNC_NEVER = 'never'
+
+def crc32(data):
+    return zlib.crc32(data) & 0xffffffff
+
+# A preallocated, memory-mapped file holding records from the logical offset base onwards
+class Segment:
+    def __init__(self, path, base, size):
+        self.path = path
+        self.base = base
+        exists = os.path.exists(path)
+        self.file = open(path, 'r+b' if exists else 'w+b')
+        # A crash right after creating the file leaves it empty, it is preallocated like a new segment then
+        if os.path.getsize(path) < HEADER.size:
+            self.file.truncate(size)
+        self.size = os.path.getsize(path)
+        self.mm = mmap.mmap(self.file.fileno(), self.size)
+        self.end = self.scan()
+
+    # Returns the position after the last valid record, a torn or corrupt record ends the segment
+    def scan(self):
+        pos = 0
+        while pos + HEADER.size <= self.size:
+            length, crc = HEADER.unpack_from(self.mm, pos)
+            start = pos + HEADER.size
+            if length == 0 or start + length > self.size or crc32(self.mm[start:start + length]) != crc:
+                break
+            pos = start + length
+        return pos
+
+    def fits(self, record):
+        return self.end + HEADER.size + len(record) <= self.size
+
+    def append(self, record):
+        pos = self.end
+        start = pos + HEADER.size
+        self.mm[start:start + len(record)] = record
+        HEADER.pack_into(self.mm, pos, len(record), crc32(record))
+        self.end = start + len(record)
+        # Terminate the segment so that leftovers of an earlier torn write are never read back
+        if self.end + HEADER.size <= self.size:
+            HEADER.pack_into(self.mm, self.end, 0, 0)
+
+    # Returns the record at pos and the position of the next one, or None at the end of the segment
+    def read(self, pos):
+        if pos >= self.end:
+            return None
+        length = HEADER.unpack_from(self.mm, pos)[0]
+        start = pos + HEADER.size
+        return self.mm[start:start + length], start + length
+
+    def flush(self):
+        self.mm.flush()
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+# An append-only log of records stored in segment files in a directory. Records are addressed by logical
+# offsets; everything before the checkpoint has been delivered and its segments are deleted
+class SegmentLog:
+    def __init__(self, directory, segment_size = 16 * 1024 * 1024, fsync_policy = FSYNC_INTERVAL, fsync_interval = 1.0):
+        if fsync_policy not in (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER):
+            raise ValueError('Invalid fsync policy: ' + str(fsync_policy))
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self.last_sync = clock()
+        self.dirty = False
+        # The checkpoint file is rewritten at most once per fsync_interval, except with fsync_policy always
+        self.last_checkpoint_write = clock()
+        self.checkpoint_dirty = False
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.checkpoint = self.read_checkpoint()
+        self.segments = []
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(SEGMENT_SUFFIX):
+                base = int(name[:-len(SEGMENT_SUFFIX)])
+                self.segments.append(Segment(os.path.join(directory, name), base, segment_size))
+        self.delete_delivered()
+        if len(self.segments) == 0:
+            self.segments.append(self.create_segment(self.checkpoint, self.segment_size))
+        self.active = self.segments[-1]
+        if self.checkpoint < self.segments[0].base:
+            self.checkpoint = self.segments[0].base
+
+    def segment_path(self, base):
+        return os.path.join(self.directory, '%020d' % base + SEGMENT_SUFFIX)
+
+    def create_segment(self, base, size):
+        return Segment(self.segment_path(base), base, size)
+
+    def read_checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT_FILE)) as f:
+                return int(f.read().strip() or 0)
+        except (IOError, OSError, ValueError):
+            return 0
+
+    # Logical offset after the last record
+    def end_offset(self):
+        return self.active.base + self.active.end
+
+    # Appends the record (bytes) and returns the offset after it
+    def append(self, record):
+        if not self.active.fits(record):
+            self.active.flush()
+            size = max(self.segment_size, HEADER.size * 2 + len(record))
+            self.active = self.create_segment(self.end_offset(), size)
+            self.segments.append(self.active)
+        self.active.append(record)
+        self.dirty = True
+        self.sync(False)
+        return self.end_offset()
+
+    # Flushes the active segment and writes the checkpoint as per the fsync policy, forced flushes ignore the interval
+    def sync(self, force):
+        self.sync_checkpoint(force)
+        if self.fsync_policy == FSYNC_NEVER or not self.dirty:
+            return
+        if force or self.sync_due():
+            self.active.flush()
+            self.dirty = False
+            self.last_sync = clock()
+
+    def sync_due(self):
+        return self.fsync_policy == FSYNC_ALWAYS or (self.fsync_policy == FSYNC_INTERVAL and clock() - self.last_sync >= self.fsync_interval)
+
+    # Returns the record at offset and the offset of the next one, or None if there is no record there
+    def read(self, offset):
+        for i in range(len(self.segments) - 1, -1, -1):
+            segment = self.segments[i]
+            if segment.base <= offset:
+                result = segment.read(offset - segment.base)
+                if result == None:
+                    if i + 1 < len(self.segments):
+                        return self.read_from_segment(i + 1, offset)
+                    return None
+                return result[0], segment.base + result[1]
+        return None
+
+    def read_from_segment(self, index, offset):
+        segment = self.segments[index]
+        if segment.base != offset:
+            return None
+        result = segment.read(0)
+        if result == None:
+            return None
+        return result[0], segment.base + result[1]
+
+    # Records everything before offset as delivered. A checkpoint lost in a crash only means that some
+    # delivered messages are sent again, so the file is written in batches
+    def commit(self, offset):
+        if offset <= self.checkpoint:
+            return
+        self.checkpoint = offset
+        self.checkpoint_dirty = True
+        self.delete_delivered()
+        self.sync_checkpoint(False)
+
+    def sync_checkpoint(self, force):
+        if not self.checkpoint_dirty:
+            return
+        if not force and self.fsync_policy != FSYNC_ALWAYS and clock() - self.last_checkpoint_write < self.fsync_interval:
+            return
+        path = os.path.join(self.directory, CHECKPOINT_FILE)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(str(self.checkpoint))
+            if self.fsync_policy != FSYNC_NEVER:
+                f.flush()
+                os.fsync(f.fileno())
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+        self.checkpoint_dirty = False
+        self.last_checkpoint_write = clock()
+
+    # Deletes the segments whose records are all before the checkpoint, the active one is kept
+    def delete_delivered(self):
+        while len(self.segments) > 1 and self.segments[1].base <= self.checkpoint:
+            segment = self.segments.pop(0)
+            segment.close()
+            os.remove(segment.path)
+
+    # Bytes of records not yet delivered
+    def backlog(self):
+        return self.end_offset() - self.checkpoint
+
+    def close(self):
+        self.sync(True)
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
+
+# Store-and-forward delivery for a gateway. Messages are appended to a SegmentLog and the put returns
+# once they are stored; a forwarder thread delivers them in order with gateway.forward_async, packing
+# consecutive events into bulk messages and keeping up to max_inflight messages outstanding.
+# The checkpoint only moves past messages Datonis accepted, so a failed message is retried (with backoff)
+# together with everything after it, including after a restart. A message Datonis rejects for good (see
+# edge_util.is_rejected) is moved to the dead letter file instead, so it cannot hold up the messages after it
+class Outbox:
+    def __init__(self, gateway, directory, segment_size = 16 * 1024 * 1024, fsync_policy = FSYNC_INTERVAL, fsync_interval = 1.0,
+                 max_batch_events = 500, max_batch_bytes = 256 * 1024, max_inflight = 4, retry_delay = 1, max_retry_delay = 60):
+        self.gateway = gateway
+        self.log = SegmentLog(directory, segment_size, fsync_policy, fsync_interval)
+        self.max_batch_events = max_batch_events
+        self.max_batch_bytes = max_batch_bytes
+        self.max_inflight = max_inflight
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.current_retry_delay = retry_delay
+        self.retry_at = 0
+        # Set when the rate limiter of the gateway holds back the next message
+        self.throttled_until = 0
+        self.condition = threading.Condition()
+        self.cursor = self.log.checkpoint
+        # (start offset, end offset, future) of the messages sent and not yet committed, in order
+        self.inflight = collections.deque()
+        self.stopped = False
+        # Counters
+        self.stored = 0
+        self.forwarded = 0
+        self.failures = 0
+        self.dead_letters = 0
+        self.thread = threading.Thread(target=self.run, name='outbox-forwarder')
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Stores the message for delivery. kind is 'event' or 'alert'.
+    # Returns a Future which resolves to True once the message is stored
+    def put(self, kind, payload):
+        record = json.dumps([kind, payload], separators=(',', ':')).encode('utf-8')
+        try:
+            with self.condition:
+                self.log.append(record)
+                self.stored += 1
+                self.condition.notify()
+        except (IOError, OSError, ValueError):
+            logging.error('Could not store message in outbox', exc_info=True)
+            return edge_util.completed_future(False)
+        return edge_util.completed_future(True)
+
+    # Bytes stored and not yet delivered
+    def backlog(self):
+        with self.condition:
+            return self.log.backlog()
+
+    def close(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join()
+        with self.condition:
+            self.log.close()
+
+    def notify(self, future):
+        with self.condition:
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    if self.stopped:
+                        return
+                    self.collect_completed()
+                    now = clock()
+                    resume_at = max(self.retry_at, self.throttled_until)
+                    if now < resume_at:
+                        self.condition.wait(resume_at - now)
+                    elif self.cursor >= self.log.end_offset() or len(self.inflight) >= self.max_inflight:
+                        self.log.sync(False)
+                        self.condition.wait(1)
+                    else:
+                        break
+                records = self.read_records()
+            if len(records) == 0:
+                continue
+            try:
+                kind, payload, start, end, size = self.pack(records)
+                if self.admit(kind, payload, size):
+                    self.forward(kind, payload, start, end)
+            except:
+                logging.error('Outbox forwarding failed', exc_info=True)
+                with self.condition:
+                    self.fail(self.inflight[0][0] if len(self.inflight) > 0 else self.cursor)
+
+    # Commits the completed messages at the head of the window, a failed one rewinds the cursor to it
+    def collect_completed(self):
+        while len(self.inflight) > 0 and self.inflight[0][2].done():
+            start, end, future = self.inflight.popleft()
+            if not future.cancelled() and future.exception() == None and future.result() == True:
+                self.log.commit(end)
+                self.forwarded += 1
+                self.current_retry_delay = self.retry_delay
+            elif not future.cancelled() and future.exception() == None and edge_util.is_rejected(future):
+                self.dead_letter(start, end, future.http_code)
+                self.log.commit(end)
+            else:
+                self.fail(start)
+                return
+
+    # Appends the records of a rejected message to the dead letter file
+    def dead_letter(self, start, end, code):
+        self.dead_letters += 1
+        logging.error('Datonis rejected an outbox message with ' + str(code) + ', moving it to ' + DEAD_LETTER_FILE)
+        try:
+            with open(os.path.join(self.log.directory, DEAD_LETTER_FILE), 'ab') as f:
+                offset = start
+                while offset < end:
+                    result = self.log.read(offset)
+                    if result == None:
+                        break
+                    f.write(bytes(result[0]) + b'\n')
+                    offset = result[1]
+        except (IOError, OSError):
+            logging.error('Could not write the outbox dead letter file', exc_info=True)
+
+    # Rewinds to the failed message and drops the rest of the window, so that all of it is sent again in order,
+    # then backs off before retrying
+    def fail(self, start):
+        if self.gateway.metrics != None:
+            self.gateway.metrics.retried(1 + len(self.inflight))
+        self.cursor = start
+        self.inflight.clear()
+        self.failures += 1
+        logging.warning('Outbox delivery failed, retrying in ' + str(self.current_retry_delay) + ' seconds')
+        self.retry_at = clock() + self.current_retry_delay
+        self.current_retry_delay = min(self.current_retry_delay * 2, self.max_retry_delay)
+
+    # Reads the raw records for the next message, returns (offset, next offset, record) tuples
+    def read_records(self):
+        records = []
+        offset = self.cursor
+        size = 0
+        while len(records) < self.max_batch_events and size < self.max_batch_bytes:
+            result = self.log.read(offset)
+            if result == None:
+                break
+            records.append((offset, result[1], result[0]))
+            size += len(result[0])
+            offset = result[1]
+        return records
+
+    # Returns the message for the first record, packed with the events directly after it if it is an event,
+    # as (kind, payload, start offset, end offset, size of the records)
+    def pack(self, records):
+        kind, payload = json.loads(edge_util.get_str(records[0][2]), object_pairs_hook=collections.OrderedDict)
+        end = records[0][1]
+        size = len(records[0][2])
+        if kind == 'event':
+            events = []
+            self.add_events(events, payload)
+            for start, next_offset, record in records[1:]:
+                next_kind, next_payload = json.loads(edge_util.get_str(record), object_pairs_hook=collections.OrderedDict)
+                if next_kind != 'event':
+                    break
+                self.add_events(events, next_payload)
+                end = next_offset
+                size += len(record)
+            if len(events) > 1:
+                payload = collections.OrderedDict()
+                payload['events'] = events
+            else:
+                payload = events[0]
+        return kind, payload, records[0][0], end, size
+
+    # Returns True if the rate limiter of the gateway lets the message through now, otherwise the forwarder
+    # waits as long as the limiter asks before reading the message again. Messages stay in order
+    def admit(self, kind, payload, size):
+        limiter = self.gateway.rate_limiter
+        if limiter == None:
+            return True
+        wait = limiter.acquire(kind, payload, size)
+        if wait == 0:
+            return True
+        with self.condition:
+            self.throttled_until = clock() + wait
+        return False
+
+    def forward(self, kind, payload, start, end):
+        future = self.gateway.forward_async(kind, payload)
+        with self.condition:
+            self.cursor = end
+            self.inflight.append((start, end, future))
+        future.add_done_callback(self.notify)
+
+    def add_events(self, events, payload):
+        if 'events' in payload:
+            events.extend(payload['events'])
+        else:
+            events.append(payload)
@@ -0,0 +1,91 @@
+import collections
+import threading
+from concurrent.futures import Future
+
+# Lanes of outgoing messages, a lower lane is sent first
+HIGH = 0
+NORMAL = 1
+LOW = 2
+LANES = 3
+
+STRICT = 'strict'
+WEIGHTED = 'weighted'
+
+# Lane of each kind of message unless GatewayConfig.priorities says otherwise
+DEFAULT_PRIORITIES = {'alert': HIGH, 'instruction_ack': HIGH, 'heartbeat': NORMAL, 'register': NORMAL, 'event': LOW}
+
+# Decides which of the lanes with waiting messages goes next. strict always takes the highest lane with messages,
+# weighted takes up to weights[lane] messages from each lane per round so that the low lanes are never starved
+class LaneScheduler:
+    def __init__(self, scheduling = STRICT, weights = (8, 4, 1)):
+        if scheduling not in (STRICT, WEIGHTED):
+            raise ValueError('Invalid priority scheduling: ' + str(scheduling))
+        if len(weights) != LANES or min(weights) < 1:
+            raise ValueError('Priority weights need a positive weight for each of the ' + str(LANES) + ' lanes')
+        self.scheduling = scheduling
+        self.weights = tuple(weights)
+        self.credits = list(weights)
+
+    # Returns the lanes to take the next message from in order of preference, sizes holds the messages waiting per lane
+    def order(self, sizes):
+        waiting = [lane for lane in range(LANES) if sizes[lane] > 0]
+        if self.scheduling == STRICT or len(waiting) < 2:
+            return waiting
+        if all(self.credits[lane] <= 0 for lane in waiting):
+            self.credits = list(self.weights)
+        first = [lane for lane in waiting if self.credits[lane] > 0][0]
+        return [first] + [lane for lane in waiting if lane != first]
+
+    # Records that a message of lane was taken
+    def taken(self, lane):
+        if self.scheduling == WEIGHTED:
+            self.credits[lane] -= 1
+
+# Runs submitted calls on up to max_workers threads like a ThreadPoolExecutor, but takes the waiting calls
+# from the lanes as per the LaneScheduler instead of in submission order
+class LaneExecutor:
+    def __init__(self, max_workers, scheduler, name = 'lane-executor'):
+        self.max_workers = max_workers
+        self.scheduler = scheduler
+        self.name = name
+        self.condition = threading.Condition()
+        self.lanes = [collections.deque() for lane in range(LANES)]
+        self.threads = []
+        self.idle = 0
+
+    # Returns a Future for the result of fn(*args)
+    def submit(self, lane, fn, *args):
+        future = Future()
+        with self.condition:
+            self.lanes[lane].append((future, fn, args))
+            if self.idle == 0 and len(self.threads) < self.max_workers:
+                thread = threading.Thread(target=self.run, name=self.name + '-' + str(len(self.threads)))
+                thread.daemon = True
+                self.threads.append(thread)
+                thread.start()
+            self.condition.notify()
+        return future
+
+    # Number of calls waiting for a worker in each lane
+    def sizes(self):
+        with self.condition:
+            return [len(queue) for queue in self.lanes]
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.idle += 1
+                while True:
+                    lanes = self.scheduler.order([len(queue) for queue in self.lanes])
+                    if len(lanes) > 0:
+                        break
+                    self.condition.wait()
+                self.idle -= 1
+                future, fn, args = self.lanes[lanes[0]].popleft()
+                self.scheduler.taken(lanes[0])
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
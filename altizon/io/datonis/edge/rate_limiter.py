@@ -0,0 +1,124 @@
+import threading
+
+from . import edge_util
+from .deadline_scheduler import clock
+
+# Allows rate tokens per second on average and bursts of up to burst tokens
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.updated = clock()
+
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    # Seconds until amount tokens are available, 0 if they are. An amount above the burst only waits for a
+    # full bucket and then leaves it in debt, so the average rate still holds
+    def wait_time(self, amount, now):
+        self.refill(now)
+        amount = min(amount, self.burst)
+        if self.tokens >= amount:
+            return 0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        self.tokens -= amount
+
+    def is_full(self, now):
+        self.refill(now)
+        return self.tokens >= self.burst
+
+# Number of events per thing in an event (single or bulk) or alert
+def thing_counts(kind, payload):
+    if kind == 'alert':
+        keys = [payload['alert'].get('thing_key')]
+    elif 'events' in payload:
+        keys = [event.get('thing_key') for event in payload['events']]
+    else:
+        keys = [payload.get('thing_key')]
+    counts = {}
+    for thing_key in keys:
+        if thing_key != None:
+            counts[thing_key] = counts.get(thing_key, 0) + 1
+    return counts
+
+# Token buckets limiting the messages a gateway sends: messages and bytes per second for the whole gateway,
+# messages per second for each kind ('event' or 'alert') in per_kind, and events per second for each thing.
+# Every bucket allows bursts of burst_seconds worth of its rate. The limiter never waits itself, acquire
+# tells the caller (the send queue or outbox thread) how long to hold the message back
+class RateLimiter:
+    # Idle per thing buckets are dropped once there are more than this many
+    MAX_THING_BUCKETS = 10000
+
+    def __init__(self, messages_per_second = None, bytes_per_second = None, per_thing = None, per_kind = None, burst_seconds = 1.0):
+        self.burst_seconds = burst_seconds
+        self.messages = self.create_bucket(messages_per_second)
+        self.bytes = self.create_bucket(bytes_per_second)
+        self.per_thing = per_thing
+        self.kinds = {}
+        for kind, rate in (per_kind or {}).items():
+            self.kinds[kind] = self.create_bucket(rate)
+        self.things = {}
+        self.lock = threading.Lock()
+        # Counters
+        self.passed = 0
+        self.throttled = 0
+
+    def create_bucket(self, rate):
+        if rate == None:
+            return None
+        return TokenBucket(rate, rate * self.burst_seconds)
+
+    # True if acquire needs the size of the messages
+    def limits_bytes(self):
+        return self.bytes != None
+
+    # Size of the message as sent, before compression
+    def measure(self, payload):
+        return len(edge_util.serialize(payload))
+
+    # Seconds until the gateway wide limits allow any message, 0 if they do
+    def gateway_delay(self):
+        now = clock()
+        with self.lock:
+            wait = 0
+            if self.messages != None:
+                wait = self.messages.wait_time(1, now)
+            if self.bytes != None:
+                wait = max(wait, self.bytes.wait_time(1, now))
+            return wait
+
+    # Takes the tokens for the message and returns 0, or returns the seconds to wait before asking again if
+    # any of its buckets is short. size is needed if bytes are limited
+    def acquire(self, kind, payload, size = 0):
+        now = clock()
+        counts = thing_counts(kind, payload) if self.per_thing != None else {}
+        with self.lock:
+            demands = [(self.messages, 1), (self.bytes, size), (self.kinds.get(kind), 1)]
+            for thing_key, count in counts.items():
+                demands.append((self.get_thing_bucket(thing_key, now), count))
+            wait = 0
+            for bucket, amount in demands:
+                if bucket != None:
+                    wait = max(wait, bucket.wait_time(amount, now))
+            if wait > 0:
+                self.throttled += 1
+                return wait
+            for bucket, amount in demands:
+                if bucket != None:
+                    bucket.take(amount)
+            self.passed += 1
+            return 0
+
+    def get_thing_bucket(self, thing_key, now):
+        bucket = self.things.get(thing_key)
+        if bucket == None:
+            if len(self.things) >= self.MAX_THING_BUCKETS:
+                # A full bucket is the same as a new one
+                self.things = dict((k, b) for k, b in self.things.items() if not b.is_full(now))
+            bucket = self.things[thing_key] = self.create_bucket(self.per_thing)
+        return bucket
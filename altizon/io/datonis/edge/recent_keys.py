@@ -0,0 +1,43 @@
+import collections
+import threading
+
+from .deadline_scheduler import clock
+
+# Remembers up to max_size keys for ttl_seconds each (None keeps them until they are evicted).
+# Keys are kept in the order they were first seen, so the oldest is evicted first when the cache is full
+class RecentKeys:
+    def __init__(self, max_size = 1024, ttl_seconds = None):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.keys = collections.OrderedDict()
+        # Counters
+        self.hits = 0
+        self.misses = 0
+
+    # Returns True if the key was seen recently, otherwise remembers it and returns False
+    def check_and_add(self, key):
+        now = clock()
+        with self.lock:
+            self.expire(now)
+            if key in self.keys:
+                self.hits += 1
+                return True
+            self.misses += 1
+            self.keys[key] = now
+            while len(self.keys) > self.max_size:
+                self.keys.popitem(False)
+            return False
+
+    def expire(self, now):
+        if self.ttl_seconds == None:
+            return
+        while len(self.keys) > 0:
+            key, seen_at = next(iter(self.keys.items()))
+            if now - seen_at < self.ttl_seconds:
+                break
+            del self.keys[key]
+
+    def __len__(self):
+        with self.lock:
+            return len(self.keys)
@@ -0,0 +1,57 @@
+import random
+import threading
+
+from .deadline_scheduler import clock
+
+# Decides how long to wait before each attempt to reconnect after the connection dropped.
+# The first attempt is made right away, after that the delay grows exponentially from min_delay up to
+# max_delay with full jitter (a random delay between 0 and the current cap), so that many gateways losing
+# the same network do not reconnect in lockstep. Counts the attempts and the time spent disconnected
+class ReconnectPolicy:
+    def __init__(self, min_delay = 1.0, max_delay = 120.0, multiplier = 2.0, jitter = True):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        # Attempts since the connection was last established
+        self.attempts = 0
+        self.disconnected_since = None
+        # Counters
+        self.reconnect_attempts = 0
+        self.reconnects = 0
+        self.disconnected_seconds = 0.0
+
+    # Returns the seconds to wait before the next attempt
+    def next_delay(self):
+        with self.lock:
+            attempt = self.attempts
+            self.attempts += 1
+            self.reconnect_attempts += 1
+        if attempt == 0:
+            return 0
+        # The exponent is bounded so that a long outage cannot overflow it
+        cap = min(self.max_delay, self.min_delay * self.multiplier ** min(attempt - 1, 64))
+        if self.jitter:
+            return random.uniform(0, cap)
+        return cap
+
+    def on_disconnected(self):
+        with self.lock:
+            if self.disconnected_since == None:
+                self.disconnected_since = clock()
+
+    def on_connected(self):
+        with self.lock:
+            if self.disconnected_since != None:
+                self.disconnected_seconds += clock() - self.disconnected_since
+                self.disconnected_since = None
+                self.reconnects += 1
+            self.attempts = 0
+
+    # Seconds spent disconnected in total, including the current outage
+    def time_disconnected(self):
+        with self.lock:
+            if self.disconnected_since == None:
+                return self.disconnected_seconds
+            return self.disconnected_seconds + clock() - self.disconnected_since
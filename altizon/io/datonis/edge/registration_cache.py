@@ -0,0 +1,98 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+# Remembers a fingerprint of what was last registered with Datonis for each thing_key, so that things whose
+# metadata did not change are not registered again after a restart. The fingerprints are appended to a file
+# as 'fingerprint thing_key' lines, the last line for a thing_key wins and the file is compacted on load.
+# The access_key and api_host of the gateway_config are part of the fingerprint, so a cache file used with
+# another Datonis account or endpoint does not skip registrations there
+class RegistrationCache:
+    def __init__(self, path, gateway_config = None):
+        self.path = path
+        self.gateway_config = gateway_config
+        self.lock = threading.Lock()
+        self.fingerprints = {}
+        lines = self.load()
+        if lines > 2 * len(self.fingerprints):
+            self.compact()
+        self.file = open(self.path, 'a')
+        # Counters
+        self.skipped = 0
+        self.registered = 0
+
+    # Returns the number of lines read
+    def load(self):
+        lines = 0
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    lines += 1
+                    parts = line.rstrip('\n').split(' ', 1)
+                    if len(parts) != 2:
+                        continue
+                    if parts[0] == '-':
+                        self.fingerprints.pop(parts[1], None)
+                    else:
+                        self.fingerprints[parts[1]] = parts[0]
+        except (IOError, OSError):
+            pass
+        return lines
+
+    def compact(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for thing_key, fingerprint in self.fingerprints.items():
+                f.write(fingerprint + ' ' + thing_key + '\n')
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp_path, self.path)
+
+    # Hash of the registered attributes of the thing and where it is registered, the registration timestamp is left out
+    def fingerprint(self, thing):
+        target = {}
+        if self.gateway_config != None:
+            target = {'access_key': str(self.gateway_config.access_key), 'api_host': str(self.gateway_config.api_host)}
+        data = json.dumps([target, thing.__dict__], sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    # Returns the fingerprint of the thing, or None if it was registered with the same attributes before
+    def changed(self, thing):
+        fingerprint = self.fingerprint(thing)
+        with self.lock:
+            if self.fingerprints.get(thing.thing_key) == fingerprint:
+                self.skipped += 1
+                return None
+        return fingerprint
+
+    # Records that Datonis accepted the registration of the thing with this fingerprint
+    def record(self, thing_key, fingerprint):
+        self.write(thing_key, fingerprint)
+        with self.lock:
+            self.registered += 1
+
+    # Forgets the thing, so that it is registered again next time
+    def forget(self, thing_key):
+        self.write(thing_key, None)
+
+    def write(self, thing_key, fingerprint):
+        with self.lock:
+            if fingerprint == None:
+                if self.fingerprints.pop(thing_key, None) == None:
+                    return
+            else:
+                if self.fingerprints.get(thing_key) == fingerprint:
+                    return
+                self.fingerprints[thing_key] = fingerprint
+            try:
+                self.file.write(('-' if fingerprint == None else fingerprint) + ' ' + thing_key + '\n')
+                # A line lost in a crash only means that the thing is registered again
+                self.file.flush()
+            except (IOError, OSError, ValueError):
+                logging.error('Could not write to the registration cache', exc_info=True)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
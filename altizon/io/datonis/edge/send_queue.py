@@ -0,0 +1,252 @@
+import collections
+import itertools
+import logging
+import threading
+from concurrent.futures import Future
+
+from . import priority_lanes
+from . import rate_limiter
+from .deadline_scheduler import clock
+
+# What put does when the queue is full
+BLOCK = 'block'
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+DOWNSAMPLE = 'downsample'
+
+POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST, DOWNSAMPLE)
+
+# A message waiting in the SendQueue
+class QueuedMessage:
+    def __init__(self, kind, payload, lane):
+        self.kind = kind
+        self.payload = payload
+        self.lane = lane
+        self.future = Future()
+        self.future.set_running_or_notify_cancel()
+        # Serialized size, only measured for a rate limit on bytes
+        self.size = None
+
+    # The thing a single event or alert is for, None for bulk messages
+    def thing_key(self):
+        if self.kind == 'alert':
+            return self.payload['alert'].get('thing_key')
+        return self.payload.get('thing_key')
+
+# A bounded queue in front of a gateway. Producers put messages without waiting for the network and get a
+# Future for the delivery result; a dispatcher thread sends them with gateway.forward_async, keeping at most
+# max_inflight messages outstanding. When the queue holds max_size messages the policy decides:
+#   block        put waits for space (at most block_timeout seconds if set, then the message is dropped)
+#   drop-oldest  the oldest queued message is dropped
+#   drop-newest  the new message is dropped
+#   downsample   every other queued event of each thing is dropped, alerts and bulk messages are kept
+# Messages wait in priority lanes by kind (see GatewayConfig.get_priority) and the dispatcher takes them from
+# the lanes as per the LaneScheduler of the gateway_config. Dropping starts with the lowest lane, a message is
+# never dropped to make room for one of a lower lane. With block, a message of a higher lane than the lowest
+# queued one does not wait but drops the newest message of that lane. Dropped messages resolve to False. on_high_watermark(queue) is called when the queue grows to
+# high_watermark messages, on_low_watermark(queue) when it drains back to low_watermark.
+# With a gateway.rate_limiter the dispatcher holds back messages the limiter does not let through yet and
+# sends later messages of other things meanwhile, so the queue fills up and the policy applies
+class SendQueue:
+    # Queued messages the dispatcher looks at for one the rate limiter lets through
+    RATE_LIMIT_SCAN = 100
+
+    def __init__(self, gateway, max_size = 1000, policy = BLOCK, max_inflight = 20, block_timeout = None,
+                 high_watermark = None, low_watermark = None, on_high_watermark = None, on_low_watermark = None):
+        if policy not in POLICIES:
+            raise ValueError('Invalid backpressure policy: ' + str(policy))
+        self.gateway = gateway
+        self.max_size = max_size
+        self.policy = policy
+        self.max_inflight = max_inflight
+        self.block_timeout = block_timeout
+        self.high_watermark = max_size if high_watermark == None else high_watermark
+        self.low_watermark = self.high_watermark // 2 if low_watermark == None else low_watermark
+        self.on_high_watermark = on_high_watermark
+        self.on_low_watermark = on_low_watermark
+        self.above_high_watermark = False
+        self.condition = threading.Condition()
+        self.lanes = [collections.deque() for lane in range(priority_lanes.LANES)]
+        self.scheduler = gateway.gateway_config.create_lane_scheduler()
+        self.inflight = 0
+        # Counters
+        self.enqueued = 0
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, name='send-queue')
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Queues the message, kind is 'event' or 'alert'. Returns a Future which resolves to the delivery result
+    def put(self, kind, payload):
+        message = QueuedMessage(kind, payload, self.gateway.gateway_config.get_priority(kind))
+        dropped = []
+        crossed = False
+        with self.condition:
+            accepted = self.queued() < self.max_size or self.make_room(message.lane, dropped)
+            if accepted:
+                self.lanes[message.lane].append(message)
+                self.enqueued += 1
+                crossed = self.check_high_watermark()
+                self.condition.notify_all()
+            else:
+                dropped.append(message)
+            self.dropped += len(dropped)
+        for d in dropped:
+            d.future.set_result(False)
+        if len(dropped) > 0:
+            logging.debug('Send queue full, dropped ' + str(len(dropped)) + ' messages')
+        if crossed:
+            self.fire(self.on_high_watermark)
+        return message.future
+
+    # Number of messages in all lanes
+    def queued(self):
+        return sum(len(queue) for queue in self.lanes)
+
+    # The lowest lane with messages
+    def lowest_lane(self):
+        for lane in range(len(self.lanes) - 1, -1, -1):
+            if len(self.lanes[lane]) > 0:
+                return lane
+        return None
+
+    # Frees space for a message of lane as per the policy, returns False if the new message has to be dropped instead
+    def make_room(self, lane, dropped):
+        if self.policy == BLOCK:
+            deadline = None if self.block_timeout == None else clock() + self.block_timeout
+            while self.queued() >= self.max_size:
+                # Only messages of the same or a higher lane make a message wait, lower ones give way
+                lowest = self.lowest_lane()
+                if lowest > lane:
+                    dropped.append(self.lanes[lowest].pop())
+                    return True
+                if deadline == None:
+                    self.condition.wait()
+                else:
+                    remaining = deadline - clock()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+            return True
+        lowest = self.lowest_lane()
+        if self.policy == DROP_OLDEST and lowest >= lane:
+            dropped.append(self.lanes[lowest].popleft())
+            return True
+        elif self.policy == DROP_NEWEST and lowest > lane:
+            dropped.append(self.lanes[lowest].pop())
+            return True
+        elif self.policy == DOWNSAMPLE:
+            self.downsample(dropped)
+            return self.queued() < self.max_size
+        return False
+
+    # Drops every other queued single event of each thing
+    def downsample(self, dropped):
+        seen = {}
+        for lane in range(len(self.lanes)):
+            kept = collections.deque()
+            for message in self.lanes[lane]:
+                thing_key = message.thing_key() if message.kind == 'event' else None
+                if thing_key != None:
+                    seen[thing_key] = seen.get(thing_key, 0) + 1
+                    if seen[thing_key] % 2 == 0:
+                        dropped.append(message)
+                        continue
+                kept.append(message)
+            self.lanes[lane] = kept
+
+    def check_high_watermark(self):
+        if not self.above_high_watermark and self.queued() >= self.high_watermark:
+            self.above_high_watermark = True
+            return True
+        return False
+
+    def check_low_watermark(self):
+        if self.above_high_watermark and self.queued() <= self.low_watermark:
+            self.above_high_watermark = False
+            return True
+        return False
+
+    def fire(self, callback):
+        if callback != None:
+            try:
+                callback(self)
+            except:
+                logging.error('Send queue watermark callback failed', exc_info=True)
+
+    # Number of messages waiting to be sent
+    def size(self):
+        with self.condition:
+            return self.queued()
+
+    # Number of messages waiting in each lane
+    def lane_sizes(self):
+        with self.condition:
+            return [len(queue) for queue in self.lanes]
+
+    def run(self):
+        while True:
+            with self.condition:
+                message = None
+                while message == None:
+                    if self.queued() == 0 or self.inflight >= self.max_inflight:
+                        self.condition.wait()
+                        continue
+                    message, wait = self.take_next()
+                    if message == None:
+                        self.condition.wait(wait)
+                self.inflight += 1
+                crossed = self.check_low_watermark()
+                self.condition.notify_all()
+            if crossed:
+                self.fire(self.on_low_watermark)
+            self.send(message)
+
+    # Removes and returns the next message to send, or returns (None, seconds to wait) if the rate limiter
+    # holds back all of them. The messages of a thing in a lane are always sent in order
+    def take_next(self):
+        lanes = self.scheduler.order([len(queue) for queue in self.lanes])
+        limiter = self.gateway.rate_limiter
+        if limiter == None:
+            self.scheduler.taken(lanes[0])
+            return self.lanes[lanes[0]].popleft(), 0
+        wait = limiter.gateway_delay()
+        if wait > 0:
+            return None, wait
+        for lane in lanes:
+            queue = self.lanes[lane]
+            blocked = set()
+            for index, message in enumerate(itertools.islice(queue, self.RATE_LIMIT_SCAN)):
+                thing_keys = rate_limiter.thing_counts(message.kind, message.payload)
+                if not blocked.isdisjoint(thing_keys):
+                    continue
+                if message.size == None and limiter.limits_bytes():
+                    message.size = limiter.measure(message.payload)
+                delay = limiter.acquire(message.kind, message.payload, message.size or 0)
+                if delay == 0:
+                    del queue[index]
+                    self.scheduler.taken(lane)
+                    return message, 0
+                blocked.update(thing_keys)
+                wait = delay if wait == 0 else min(wait, delay)
+        return None, wait
+
+    def send(self, message):
+        try:
+            future = self.gateway.forward_async(message.kind, message.payload)
+        except:
+            logging.error('Sending queued message failed', exc_info=True)
+            self.complete(message, False)
+            return
+        future.add_done_callback(lambda f: self.complete(message, not f.cancelled() and f.exception() == None and f.result() == True))
+
+    def complete(self, message, retval):
+        with self.condition:
+            self.inflight -= 1
+            self.sent += 1
+            if not retval:
+                self.failed += 1
+            self.condition.notify_all()
+        message.future.set_result(retval)
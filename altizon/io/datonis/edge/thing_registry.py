@@ -0,0 +1,48 @@
+import collections
+import threading
+
+# The things registered with a gateway, indexed by thing_key and kept in registration order.
+# Each thing has a metadata dict where the gateway and applications can keep per thing state
+class ThingRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.things = collections.OrderedDict()
+        self.metadata = {}
+
+    # Adds the thing, replacing a registered thing with the same thing_key.
+    # Returns True if the thing_key was not registered before
+    def add(self, thing):
+        with self.lock:
+            added = thing.thing_key not in self.things
+            self.things[thing.thing_key] = thing
+            if added:
+                self.metadata[thing.thing_key] = {}
+            return added
+
+    # Removes the thing with the specified thing_key, returns it or None if it was not registered
+    def remove(self, thing_key):
+        with self.lock:
+            self.metadata.pop(thing_key, None)
+            return self.things.pop(thing_key, None)
+
+    def get(self, thing_key):
+        return self.things.get(thing_key)
+
+    # The metadata dict of the thing, None if it is not registered
+    def get_metadata(self, thing_key):
+        return self.metadata.get(thing_key)
+
+    def keys(self):
+        with self.lock:
+            return list(self.things.keys())
+
+    def __contains__(self, thing_key):
+        return thing_key in self.things
+
+    def __len__(self):
+        return len(self.things)
+
+    # Iterates over a snapshot, so things can be added or removed meanwhile
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.things.values()))
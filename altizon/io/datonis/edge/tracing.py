@@ -0,0 +1,77 @@
+import itertools
+import logging
+import threading
+import weakref
+
+from .deadline_scheduler import clock
+
+# Stages of sending a message, in order. Over HTTP there is no enqueue and write, the ack is the response
+BUILD = 'build'
+SERIALIZE = 'serialize'
+SIGN = 'sign'
+ENQUEUE = 'enqueue'
+WRITE = 'write'
+ACK = 'ack'
+
+# Called as hook(stage, correlation_id, timestamp, info) at every stage of every message. timestamp is
+# monotonic seconds, the correlation_id is the same for all stages of one message and info is a dict with
+# details of the stage (e.g. the MQTT mid or the ack code). Hooks run on the sending, network or ack
+# threads, so they should be quick. The send path only checks this list while it is empty
+hooks = []
+
+# (weak reference to the payload, correlation_id) of the payloads built by edge_util and not sent yet, by
+# id(payload). An entry is removed when its payload is collected, so a new object at the same address never
+# picks up its correlation_id
+MAX_BUILT = 10000
+built = {}
+counter = itertools.count(1)
+# Reentrant, the weak reference callbacks take it too and the garbage collector may run them on a thread
+# that holds it already
+lock = threading.RLock()
+
+# The correlation_id of the message being published by the current thread, read when paho queues it
+current = threading.local()
+
+def add_hook(hook):
+    hooks.append(hook)
+
+def remove_hook(hook):
+    hooks.remove(hook)
+
+def emit(stage, correlation_id, **info):
+    timestamp = clock()
+    for hook in list(hooks):
+        try:
+            hook(stage, correlation_id, timestamp, info)
+        except:
+            logging.error('Tracing hook failed', exc_info=True)
+
+def next_correlation_id():
+    with lock:
+        return next(counter)
+
+# Gives a newly built payload its correlation_id
+def on_build(payload, kind):
+    correlation_id = next_correlation_id()
+    key = id(payload)
+    ref = weakref.ref(payload, lambda ref: forget(key, ref))
+    with lock:
+        # Payloads that are kept but never sent (e.g. batched events) would pile up otherwise
+        if len(built) >= MAX_BUILT:
+            built.clear()
+        built[key] = (ref, correlation_id)
+    emit(BUILD, correlation_id, kind=kind)
+
+def forget(key, ref):
+    with lock:
+        entry = built.get(key)
+        if entry != None and entry[0] is ref:
+            del built[key]
+
+# Returns the correlation_id the payload got when it was built, or a new one
+def take_correlation_id(payload):
+    with lock:
+        entry = built.pop(id(payload), None)
+    if entry != None and entry[0]() is payload:
+        return entry[1]
+    return next_correlation_id()
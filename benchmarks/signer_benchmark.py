@@ -0,0 +1,35 @@
+# Compares signing with a fresh HMAC per message (the previous edge_util.encode) against the cached Signer
+#
+# python benchmarks/signer_benchmark.py [messages]
+import hashlib
+import hmac
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from altizon.io.datonis.edge import edge_util
+
+SECRET_KEY = 'f4e31122629etaeaa48d9c8c72b8cctfc9d63acc'
+
+def fresh_hmac_encode(secret_key, payload):
+    return hmac.new(bytes(secret_key.encode('utf-8')), msg=payload.encode('utf-8'), digestmod=hashlib.sha256).hexdigest()
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    payloads = [json.dumps({'data': {'pressure': i % 100, 'temperature': i % 70}, 'thing_key': '614a5ed34c', 'timestamp': 1500000000000 + i}, separators=(',', ':')) for i in range(count)]
+    signer = edge_util.Signer(SECRET_KEY)
+    assert signer.sign_many(payloads[:10]) == [fresh_hmac_encode(SECRET_KEY, p) for p in payloads[:10]]
+
+    results = [
+        ('hmac.new per message', timeit.timeit(lambda: [fresh_hmac_encode(SECRET_KEY, p) for p in payloads], number=1)),
+        ('Signer.sign', timeit.timeit(lambda: [signer.sign(p) for p in payloads], number=1)),
+        ('Signer.sign_many', timeit.timeit(lambda: signer.sign_many(payloads), number=1)),
+    ]
+    baseline = results[0][1]
+    for name, elapsed in results:
+        print('%-22s %8.3f us/message  (%.0f%% of hmac.new)' % (name, elapsed * 1000000 / count, elapsed * 100 / baseline))
+
+main()